@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+
+class AIQueueFull(Exception):
+    """AI 请求队列已满"""
+
+
+class AIDeadlineExceeded(Exception):
+    """AI 请求在截止时间内未能开始执行"""
+
+
+class AIScheduler:
+    """OpenAI 请求调度器
+
+    使用异步客户端发起请求，并限制同时进行的请求数。超出并发上限的请求
+    进入等待队列，每个请求都有排队截止时间和执行超时，避免单个缓慢的
+    会话拖慢其他会话。
+    """
+
+    def __init__(self, client, config: Optional[Dict[str, Any]] = None):
+        config = config or {}
+        self.client = client
+        self.max_in_flight = config.get('max_in_flight', 4)
+        self.max_queue_size = config.get('max_queue_size', 100)
+        self.queue_deadline = config.get('queue_deadline', 30)
+        self.request_timeout = config.get('request_timeout', 60)
+
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._waiting = 0
+        self._in_flight = 0
+
+        # 统计信息
+        self._completed = 0
+        self._rejected = 0
+        self._expired = 0
+        self._timed_out = 0
+        self._failed = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._streams = 0
+        self._total_first_token = 0.0
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # 延迟创建，确保绑定到实际运行的事件循环
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        return self._semaphore
+
+    @asynccontextmanager
+    async def _slot(self, deadline: Optional[float] = None):
+        """排队获取一个执行名额，并统计排队和执行结果"""
+        if self._waiting >= self.max_queue_size:
+            self._rejected += 1
+            raise AIQueueFull(f"AI 请求队列已满 ({self._waiting})")
+
+        semaphore = self._get_semaphore()
+        enqueued_at = time.monotonic()
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(semaphore.acquire(), deadline or self.queue_deadline)
+        except asyncio.TimeoutError:
+            self._expired += 1
+            raise AIDeadlineExceeded(f"AI 请求排队超过 {deadline or self.queue_deadline} 秒")
+        finally:
+            self._waiting -= 1
+
+        wait_time = time.monotonic() - enqueued_at
+        self._total_wait += wait_time
+        self._max_wait = max(self._max_wait, wait_time)
+
+        self._in_flight += 1
+        try:
+            yield
+            self._completed += 1
+        except asyncio.TimeoutError:
+            self._timed_out += 1
+            raise
+        except Exception:
+            self._failed += 1
+            raise
+        finally:
+            self._in_flight -= 1
+            semaphore.release()
+            logging.debug(f"AI 请求完成 - 排队 {wait_time:.3f}s, 总耗时 {time.monotonic() - enqueued_at:.3f}s")
+
+    async def create_completion(self, deadline: Optional[float] = None, **kwargs):
+        """排队并发起一次 chat completion 请求
+
+        deadline 为排队最长等待秒数，默认使用配置中的 queue_deadline。
+        """
+        async with self._slot(deadline):
+            return await asyncio.wait_for(
+                self.client.chat.completions.create(**kwargs),
+                self.request_timeout
+            )
+
+    async def stream_completion(self, on_delta: Callable[[str], Awaitable[Any]],
+                                deadline: Optional[float] = None, **kwargs) -> str:
+        """排队并以流式方式发起 chat completion 请求
+
+        每收到一段内容都会以目前为止的完整文本调用 on_delta，返回最终文本。
+        """
+        async def consume():
+            started_at = time.monotonic()
+            stream = await self.client.chat.completions.create(stream=True, **kwargs)
+            parts = []
+            async for chunk in stream:
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                if not parts:
+                    self._streams += 1
+                    self._total_first_token += time.monotonic() - started_at
+                parts.append(chunk.choices[0].delta.content)
+                await on_delta(''.join(parts))
+            return ''.join(parts)
+
+        async with self._slot(deadline):
+            return await asyncio.wait_for(consume(), self.request_timeout)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取调度器统计信息"""
+        started = self._completed + self._timed_out + self._failed + self._in_flight
+        return {
+            'queue_depth': self._waiting,
+            'in_flight': self._in_flight,
+            'max_in_flight': self.max_in_flight,
+            'completed': self._completed,
+            'rejected': self._rejected,
+            'expired': self._expired,
+            'timed_out': self._timed_out,
+            'failed': self._failed,
+            'avg_wait': self._total_wait / started if started else 0.0,
+            'max_wait': self._max_wait,
+            'avg_first_token': self._total_first_token / self._streams if self._streams else 0.0
+        }
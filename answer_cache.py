@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import re
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence
+
+from cache import TTLCache
+from keywords import normalize
+
+# 标点、符号和连续空白在比较问题时忽略
+_SEPARATORS = re.compile(r'[\W_]+', re.UNICODE)
+
+
+def question_key(text: str) -> str:
+    """问题的归一化文本：统一全角/半角和大小写，忽略标点和多余空白"""
+    return _SEPARATORS.sub(' ', normalize(text)).strip()
+
+
+class AnswerCache:
+    """常见问题的 AI 回答缓存
+
+    以归一化后的问题文本为键缓存 AI 的回答，超过 ttl 秒失效，超过 max_size 时
+    淘汰最久未使用的回答。开启语义匹配时（需要安装 numpy），每个问题的向量保存在
+    本地索引中，未精确命中时按余弦相似度查找最相近的问题，相似度达到 threshold
+    即视为命中。
+    """
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None,
+                 embed: Optional[Callable[[str], Awaitable[Sequence[float]]]] = None):
+        config = config or {}
+        self.ttl = config.get('ttl', 86400)
+        self.max_size = config.get('max_size', 1000)
+        # 会话中已有的对话条数不超过该值时才使用缓存，避免忽略上下文
+        self.max_history = config.get('max_history', 0)
+
+        self._answers = TTLCache(ttl=self.ttl, max_size=self.max_size)
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+        # 语义匹配
+        semantic = config.get('semantic') or {}
+        self.threshold = semantic.get('threshold', 0.92)
+        # 获取向量的最长等待时间（秒），超时按未命中处理
+        self.embed_timeout = semantic.get('timeout', 3)
+        self.embed = None
+        self._np = None
+        self._vectors: Dict[str, Any] = {}
+        self._keys: List[str] = []
+        self._matrix = None
+        self._dirty = False
+        # 查询时计算的向量，写入回答时复用
+        self._recent_vectors = TTLCache(ttl=600, max_size=1000)
+        if semantic.get('enabled', False) and embed is not None:
+            try:
+                import numpy
+                self._np = numpy
+                self.embed = embed
+            except ImportError:
+                logging.warning('未安装 numpy，回答缓存仅使用精确匹配')
+
+    async def get(self, question: str) -> Optional[str]:
+        """查找缓存的回答，未命中时返回 None"""
+        key = question_key(question)
+        if not key:
+            return None
+
+        answer = self._answers.get(key)
+        if answer is not None:
+            self.exact_hits += 1
+            return answer
+
+        if self.embed is not None and self._vectors:
+            vector = await self._embedding(key)
+            if vector is not None:
+                answer = self._search(vector)
+                if answer is not None:
+                    self.semantic_hits += 1
+                    return answer
+
+        self.misses += 1
+        return None
+
+    async def put(self, question: str, answer: str):
+        """缓存一个问题的回答"""
+        key = question_key(question)
+        if not key or not answer:
+            return
+        self._answers.set(key, answer)
+        if self.embed is not None:
+            vector = await self._embedding(key)
+            if vector is not None:
+                self._vectors[key] = vector
+                self._dirty = True
+
+    async def _embedding(self, key: str):
+        vector = self._recent_vectors.get(key)
+        if vector is None:
+            try:
+                vector = self._np.asarray(
+                    await asyncio.wait_for(self.embed(key), self.embed_timeout), dtype=self._np.float32)
+            except Exception as e:
+                logging.warning(f"获取问题向量失败: {e!r}")
+                return None
+            norm = self._np.linalg.norm(vector)
+            if norm == 0:
+                return None
+            vector = vector / norm
+            self._recent_vectors.set(key, vector)
+        return vector
+
+    def _rebuild(self):
+        # 丢弃已过期或被淘汰的问题，重建向量矩阵
+        self._vectors = {key: vector for key, vector in self._vectors.items() if key in self._answers}
+        self._keys = list(self._vectors)
+        self._matrix = self._np.stack([self._vectors[key] for key in self._keys]) if self._keys else None
+        self._dirty = False
+
+    def _search(self, vector) -> Optional[str]:
+        """按余弦相似度查找最相近的问题（向量均已归一化）"""
+        if self._dirty or len(self._vectors) > self.max_size:
+            self._rebuild()
+        if self._matrix is None:
+            return None
+
+        similarities = self._matrix @ vector
+        best = int(self._np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return None
+        answer = self._answers.get(self._keys[best])
+        if answer is None:
+            # 最相近的问题已过期，下次查找时重建索引
+            self._dirty = True
+        return answer
+
+    def __len__(self) -> int:
+        return len(self._answers)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取缓存统计信息"""
+        total = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            'size': len(self._answers),
+            'indexed': len(self._vectors),
+            'exact_hits': self.exact_hits,
+            'semantic_hits': self.semantic_hits,
+            'misses': self.misses,
+            'hit_rate': (self.exact_hits + self.semantic_hits) / total if total else 0.0
+        }
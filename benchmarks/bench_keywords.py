@@ -0,0 +1,72 @@
+"""autoreply 关键词匹配基准测试
+
+用法: python benchmarks/bench_keywords.py [关键词规则数] [消息数]
+"""
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from keywords import KeywordMatcher
+
+HANZI = [chr(c) for c in range(0x4e00, 0x4e00 + 500)]
+
+
+def random_word(rng, length):
+    pool = HANZI if rng.random() < 0.5 else string.ascii_lowercase
+    return ''.join(rng.choice(pool) for _ in range(length))
+
+
+def naive_match(autoreply, content):
+    # 旧版 handler.getKey 的实现
+    for x in autoreply:
+        for key in x.split("|"):
+            if key in content:
+                return True, autoreply[x]
+    return False, None
+
+
+def main():
+    rules = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    rng = random.Random(42)
+
+    autoreply = {}
+    while len(autoreply) < rules:
+        keys = '|'.join(random_word(rng, rng.randint(3, 8)) for _ in range(rng.randint(1, 4)))
+        autoreply[keys] = f"回复 {len(autoreply)}"
+
+    samples = [random_word(rng, rng.randint(10, 120)) for _ in range(messages)]
+
+    start = time.perf_counter()
+    matcher = KeywordMatcher(autoreply)
+    compile_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for content in samples:
+        naive_match(autoreply, content)
+    naive_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for content in samples:
+        matcher.match(content)
+    matcher_time = time.perf_counter() - start
+
+    normalized = KeywordMatcher(autoreply, normalized=True)
+    start = time.perf_counter()
+    for content in samples:
+        normalized.match(content)
+    normalized_time = time.perf_counter() - start
+
+    print(f"规则数: {rules}, 消息数: {messages}")
+    print(f"自动机编译耗时: {compile_time * 1000:.1f} ms")
+    print(f"逐条匹配:       {naive_time / messages * 1e6:.1f} µs/消息")
+    print(f"自动机匹配:     {matcher_time / messages * 1e6:.1f} µs/消息")
+    print(f"自动机+归一化:  {normalized_time / messages * 1e6:.1f} µs/消息")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""SQLite 会话写入基准测试
+
+对比旧实现（每次操作新建连接、逐行 INSERT、默认 rollback 日志）与
+SessionPersistence 当前实现（长连接、WAL、executemany 单事务）的持续写入速度。
+
+用法: python benchmarks/bench_sqlite.py [会话数] [批量大小]
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from persistence import SessionPersistence
+
+
+def make_sessions(count):
+    return {
+        f"session_{i:08d}": {
+            'topicId': i,
+            'messageId': i * 10,
+            'enableAI': i % 2 == 0,
+            'last_updated': datetime.now().isoformat()
+        }
+        for i in range(count)
+    }
+
+
+def legacy_batch_save(data_file, items_to_save):
+    # 旧版 _batch_save_sqlite 的实现
+    conn = sqlite3.connect(data_file)
+    cursor = conn.cursor()
+    for session_id, session_data in items_to_save.items():
+        cursor.execute('''
+            INSERT OR REPLACE INTO sessions
+            (session_id, topic_id, message_id, enable_ai, last_updated)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (
+            session_id,
+            session_data.get('topicId'),
+            session_data.get('messageId'),
+            session_data.get('enableAI', False),
+            session_data.get('last_updated', datetime.now().isoformat())
+        ))
+    conn.commit()
+    conn.close()
+
+
+def chunks(items, size):
+    items = list(items.items())
+    for i in range(0, len(items), size):
+        yield dict(items[i:i + size])
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    sessions = make_sessions(count)
+    workdir = tempfile.mkdtemp()
+
+    # 旧实现
+    legacy_file = os.path.join(workdir, 'legacy.db')
+    conn = sqlite3.connect(legacy_file)
+    conn.execute('''
+        CREATE TABLE sessions (
+            session_id TEXT PRIMARY KEY,
+            topic_id INTEGER,
+            message_id INTEGER,
+            enable_ai BOOLEAN,
+            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+    conn.close()
+    start = time.perf_counter()
+    for batch in chunks(sessions, batch_size):
+        legacy_batch_save(legacy_file, batch)
+    legacy_time = time.perf_counter() - start
+
+    # 当前实现
+    persistence = SessionPersistence({'persistence': {
+        'storage_type': 'sqlite',
+        'data_file': os.path.join(workdir, 'current.db'),
+        'async_save': {'enabled': False}
+    }})
+    start = time.perf_counter()
+    for batch in chunks(sessions, batch_size):
+        persistence._batch_save_sqlite(batch)
+    current_time = time.perf_counter() - start
+    persistence.close()
+
+    print(f"会话数: {count}, 批量大小: {batch_size}")
+    print(f"旧实现:   {count / legacy_time:,.0f} 条/秒 ({legacy_time:.2f}s)")
+    print(f"当前实现: {count / current_time:,.0f} 条/秒 ({current_time:.2f}s)")
+
+
+if __name__ == '__main__':
+    main()
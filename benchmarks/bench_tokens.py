@@ -0,0 +1,91 @@
+"""AI 提示词组装基准测试
+
+对比每次请求重新编码全部内容的旧实现与 TokenCounter 的缓存实现。
+需要安装 tiktoken。
+
+用法: python benchmarks/bench_tokens.py [历史消息条数] [请求数]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import tiktoken
+
+from tokens import TokenCounter
+
+MODEL = 'gpt-3.5-turbo'
+HANZI = [chr(c) for c in range(0x4e00, 0x4e00 + 2000)]
+
+
+def random_text(rng, length):
+    return ''.join(rng.choice(HANZI) for _ in range(length))
+
+
+def legacy_build(system, history, current, max_tokens=4096):
+    # 旧版 handler.sendMessage 的实现：每次请求都加载编码器并重新编码全部内容
+    try:
+        encoding = tiktoken.encoding_for_model(MODEL)
+    except KeyError:
+        encoding = tiktoken.get_encoding("cl100k_base")
+    max_context_tokens = max_tokens - 1000
+    messages = [{"role": "system", "content": system}]
+    current_tokens = len(encoding.encode(system)) + 4
+    history_messages = []
+    for msg in reversed(history[-20:]):
+        msg_tokens = len(encoding.encode(msg["content"])) + 4
+        if current_tokens + msg_tokens > max_context_tokens:
+            break
+        history_messages.insert(0, msg)
+        current_tokens += msg_tokens
+    messages.extend(history_messages)
+    current_msg_tokens = len(encoding.encode(current)) + 4
+    while len(messages) > 1 and current_tokens + current_msg_tokens > max_context_tokens:
+        removed_msg = messages.pop(1)
+        current_tokens -= len(encoding.encode(removed_msg["content"])) + 4
+    messages.append({"role": "user", "content": current})
+    return messages
+
+
+def main():
+    turns = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    rng = random.Random(42)
+
+    system = random_text(rng, 800)
+    history = [
+        {"role": "user" if i % 2 else "assistant", "content": random_text(rng, rng.randint(20, 200))}
+        for i in range(turns)
+    ]
+    # 模拟对话推进：每次请求在历史末尾追加一条新消息
+    currents = [random_text(rng, rng.randint(10, 80)) for _ in range(requests)]
+
+    # 预热编码器加载，只比较稳态开销
+    tiktoken.encoding_for_model(MODEL)
+
+    start = time.perf_counter()
+    window = list(history)
+    for current in currents:
+        legacy_build(system, window, current)
+        window = (window + [{"role": "user", "content": current}])[-turns:]
+    legacy_time = time.perf_counter() - start
+
+    counter = TokenCounter(MODEL, context_size=4096)
+    counter.count(system)
+    start = time.perf_counter()
+    window = list(history)
+    for current in currents:
+        counter.build_messages(system, window[-20:], current, reserve=1000)
+        window = (window + [{"role": "user", "content": current}])[-turns:]
+    cached_time = time.perf_counter() - start
+
+    print(f"历史消息: {turns} 条, 请求数: {requests}")
+    print(f"旧实现:       {legacy_time / requests * 1000:.3f} ms/请求")
+    print(f"TokenCounter: {cached_time / requests * 1000:.3f} ms/请求")
+    print(f"缓存统计: {counter.get_stats()}")
+
+
+if __name__ == '__main__':
+    main()
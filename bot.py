@@ -1,32 +1,29 @@
 
+import clients
+import time
 import os
-import yaml
+import asyncio
 import logging
-import requests
-import boto3
-from botocore.exceptions import ClientError
-from io import BytesIO
-
-from openai import OpenAI
-from crisp_api import Crisp
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+
+from images import ImageUploader
+from telegram_scheduler import TelegramScheduler, PRIORITY_MESSAGE
+from telegram import Update
 from telegram.ext import Application, Defaults, MessageHandler, filters, ContextTypes, CallbackQueryHandler
 
 import handler
+from sessions import SessionMap
 
 # 定期清理过期会话的任务函数
 async def cleanup_expired_sessions(context: ContextTypes.DEFAULT_TYPE):
     """定期清理过期的会话数据"""
     try:
         # 清理持久化存储中的过期数据
-        handler.persistence.clean_expired_data()
+        expired = handler.persistence.clean_expired_data()
         
-        # 清理内存中的过期数据
+        # 只从内存中移除已过期的会话
         if hasattr(context, 'bot_data'):
-            # 重新加载有效数据到内存
-            valid_data = handler.persistence.load_session_data()
-            context.bot_data.clear()
-            context.bot_data.update(valid_data)
+            for session_id in expired:
+                context.bot_data.pop(session_id, None)
             
         # 获取统计信息
         stats = handler.persistence.get_stats()
@@ -35,130 +32,114 @@ async def cleanup_expired_sessions(context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logging.error(f"清理过期数据时发生错误: {e}")
 
-# Enable logging
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
-# set higher logging level for httpx to avoid all GET and POST requests being logged
-logging.getLogger("httpx").setLevel(logging.WARNING)
-
-# Load Config
-try:
-    f = open('config.yml', 'r')
-    config = yaml.safe_load(f)
-except FileNotFoundError as error:
-    logging.warning('没有找到 config.yml，请复制 config.yml.example 并重命名为 config.yml')
-    exit(1)
-
-# Connect Crisp
-try:
-    crispCfg = config['crisp']
-    client = Crisp()
-    client.set_tier("plugin")
-    client.authenticate(crispCfg['id'], crispCfg['key'])
-    client.plugin.get_connect_account()
-    client.website.get_website(crispCfg['website'])
-except Exception as error:
-    logging.warning('无法连接 Crisp 服务，请确认 Crisp 配置项是否正确')
-    exit(1)
-
-# Connect OpenAI
-try:
-    openai_config = config['openai']
-    openai = OpenAI(
-        api_key=openai_config['apiKey'],
-        base_url=openai_config.get('baseUrl', 'https://api.openai.com/v1')
-    )
-    # Test connection
-    openai.models.list()
-    logging.info('OpenAI 服务连接成功')
-except Exception as error:
-    logging.warning('无法连接 OpenAI 服务，智能化回复将不会使用: ' + str(error))
-    openai = None
-
-def changeButton(sessionId,boolean):
-    return InlineKeyboardMarkup(
-        [
-            [InlineKeyboardButton(
-                text='关闭 AI 回复' if boolean else '打开 AI 回复',
-                callback_data=f'{sessionId},{boolean}'
-                )
-            ]
-        ]
-    )
+# 配置和客户端与 handler 共用同一份，AI 客户端通过 clients.openai 访问（可能在启动检查后被关闭）
+config = clients.config
+crispCfg = clients.crispCfg
+crisp = clients.crisp
+
+# 启动耗时统计（秒），imports 包含 clients 模块中创建客户端的时间
+startedAt = clients.startedAt
+startupTimings = {'imports': time.perf_counter() - startedAt}
+
+class StartupCheckFailed(Exception):
+    """启动时的依赖服务检查未通过，与 Telegram 连接失败分开报告"""
+
+async def timed(name, coro, timeout):
+    """执行一项启动检查并记录耗时"""
+    start = time.perf_counter()
+    try:
+        return await asyncio.wait_for(coro, timeout)
+    finally:
+        startupTimings[name] = time.perf_counter() - start
+
+async def bootstrap(app: Application):
+    """启动时并发检查 Crisp 和 OpenAI 的连通性"""
+    start = time.perf_counter()
+    timeout = (config.get('startup') or {}).get('check_timeout', 10)
+
+    checks = [
+        timed('crisp_account', crisp.plugin.get_connect_account(), timeout),
+        timed('crisp_website', crisp.website.get_website(crispCfg['website']), timeout),
+    ]
+    if clients.openai is not None:
+        checks.append(timed('openai', clients.openai.models.list(), timeout))
+    results = await asyncio.gather(*checks, return_exceptions=True)
+
+    crispErrors = [result for result in results[:2] if isinstance(result, BaseException)]
+    if crispErrors:
+        raise StartupCheckFailed(f'无法连接 Crisp 服务，请确认 Crisp 配置项是否正确: {crispErrors[0]!r}')
+    if clients.openai is not None:
+        if isinstance(results[2], BaseException):
+            logging.warning(f'无法连接 OpenAI 服务，智能化回复将不会使用: {results[2]!r}')
+            clients.disableAI()
+        else:
+            logging.info('OpenAI 服务连接成功')
+            # 在后台线程预加载 tiktoken 编码器，首条消息无需等待
+            asyncio.create_task(asyncio.to_thread(preloadEncoding))
+
+    startupTimings['checks'] = time.perf_counter() - start
+    startupTimings['total'] = time.perf_counter() - startedAt
+    logging.info('启动耗时: ' + ', '.join(f'{name} {seconds:.3f}s' for name, seconds in startupTimings.items()))
+
+def preloadEncoding():
+    try:
+        handler.tokenCounter.encoding
+    except Exception as error:
+        logging.warning(f'预加载 tiktoken 编码器失败: {error}')
 
 async def onReply(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     msg = update.effective_message
 
     if msg.chat_id != config['bot']['groupId']:
         return
-    for sessionId in context.bot_data:
-        if context.bot_data[sessionId]['topicId'] == msg.message_thread_id:
-            query = {
-                "type": "text",
-                "content": msg.text,
-                "from": "operator",
-                "origin": "chat",
-                "user": {
-                    "nickname": '人工客服',
-                    "avatar": 'https://bpic.51yuansu.com/pic3/cover/03/47/92/65e3b3b1eb909_800.jpg'
-                }
-            }
-            client.website.send_message_in_conversation(
-                config['crisp']['website'],
-                sessionId,
-                query
-            )
-            return
+    sessionId = context.bot_data.get_session_id(msg.message_thread_id)
+    if sessionId is None:
+        return
+    # 客服回复后，客户的新消息不再合并到回复之前的消息中
+    handler.recentPosts.pop(msg.message_thread_id)
+    # 回复前先把客户的消息标记为已读
+    await handler.readReceipts.flush(sessionId)
+    query = {
+        "type": "text",
+        "content": msg.text,
+        "from": "operator",
+        "origin": "chat",
+        "user": {
+            "nickname": '人工客服',
+            "avatar": 'https://bpic.51yuansu.com/pic3/cover/03/47/92/65e3b3b1eb909_800.jpg'
+        }
+    }
+    await crisp.website.send_message_in_conversation(
+        config['crisp']['website'],
+        sessionId,
+        query
+    )
+    handler.recordTurn(sessionId, context.bot_data.get(sessionId), "assistant", msg.text)
 
-# EasyImages Config
-EASYIMAGES_API_URL = config.get('easyimages', {}).get('apiUrl', '')
-EASYIMAGES_API_TOKEN = config.get('easyimages', {}).get('apiToken', '')
-
-# Cloudflare R2 Config
-R2_CONFIG = config.get('cloudflare_r2', {})
-R2_ENDPOINT_URL = R2_CONFIG.get('endpoint_url', '')
-R2_ACCESS_KEY_ID = R2_CONFIG.get('access_key_id', '')
-R2_SECRET_ACCESS_KEY = R2_CONFIG.get('secret_access_key', '')
-R2_BUCKET_NAME = R2_CONFIG.get('bucket_name', '')
-R2_PUBLIC_URL = R2_CONFIG.get('public_url', '')
-
-# 初始化 R2 客户端
-r2_client = None
-if R2_ENDPOINT_URL and R2_ACCESS_KEY_ID and R2_SECRET_ACCESS_KEY and R2_BUCKET_NAME:
-    try:
-        r2_client = boto3.client(
-            's3',
-            endpoint_url=R2_ENDPOINT_URL,
-            aws_access_key_id=R2_ACCESS_KEY_ID,
-            aws_secret_access_key=R2_SECRET_ACCESS_KEY,
-            region_name='auto'  # R2 使用 'auto' 作为区域
-        )
-        logging.info('Cloudflare R2 客户端初始化成功')
-    except Exception as e:
-        logging.warning(f'Cloudflare R2 客户端初始化失败: {e}')
-        r2_client = None
-else:
-    logging.info('Cloudflare R2 配置不完整，将仅使用 EasyImages')
+# 图片转存（Cloudflare R2 / EasyImages）
+imageUploader = ImageUploader(config)
 
 async def handleImage(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.effective_message
 
     if msg.photo:
-        file_id = msg.photo[-1].file_id
+        attachment = msg.photo[-1]
     elif msg.document and msg.document.mime_type.startswith('image/'):
-        file_id = msg.document.file_id
+        attachment = msg.document
     else:
         await msg.reply_text("请发送图片文件。")
         return
 
     try:
-        # 获取文件下载 URL
-        file = await context.bot.get_file(file_id)
-        file_url = file.file_path
+        # 同一张图片已经上传过时直接复用链接
+        uploaded_url = await imageUploader.lookup(attachment.file_unique_id)
+        if uploaded_url is None:
+            # 获取文件下载 URL
+            file = await context.bot.get_file(attachment.file_id)
+            file_url = file.file_path
 
-        # 上传图片（优先 R2，失败时回退到 EasyImages）
-        uploaded_url = upload_image_with_fallback(file_url)
+            # 上传图片（优先 R2，失败时回退到 EasyImages）
+            uploaded_url = await imageUploader.upload(file_url, attachment.file_unique_id)
 
         # 生成 Markdown 格式的链接
         markdown_link = f"![Image]({uploaded_url})"
@@ -167,7 +148,8 @@ async def handleImage(update: Update, context: ContextTypes.DEFAULT_TYPE):
         session_id = get_target_session_id(context, msg.message_thread_id)
         if session_id:
             # 将 Markdown 链接推送给客户
-            send_markdown_to_client(session_id, markdown_link)
+            await send_markdown_to_client(session_id, markdown_link)
+            handler.recordTurn(session_id, context.bot_data.get(session_id), "assistant", markdown_link)
             await msg.reply_text("图片已成功发送给客户！")
         else:
             await msg.reply_text("未找到对应的 Crisp 会话，无法发送给客户。")
@@ -176,118 +158,13 @@ async def handleImage(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await msg.reply_text("图片上传失败，请稍后重试。")
         logging.error(f"图片上传错误: {e}")
 
-def upload_image_to_easyimages(file_url):
-    try:
-        response = requests.get(file_url, stream=True)
-        response.raise_for_status()
-
-        files = {
-            'image': ('image.jpg', response.raw, 'image/jpeg'),
-            'token': (None, EASYIMAGES_API_TOKEN)
-        }
-        res = requests.post(EASYIMAGES_API_URL, files=files)
-        res_data = res.json()
-
-        if res_data.get("result") == "success":
-            return res_data["url"]
-        else:
-            raise Exception(f"Image upload failed: {res_data}")
-    except Exception as e:
-        logging.error(f"Error uploading image: {e}")
-        raise
-
-def upload_image_to_r2(file_url):
-    """上传图片到 Cloudflare R2"""
-    try:
-        if not r2_client:
-            raise Exception("R2 客户端未初始化")
-        
-        # 下载图片
-        response = requests.get(file_url)
-        response.raise_for_status()
-        
-        # 生成唯一的文件名
-        import uuid
-        import mimetypes
-        
-        # 从 URL 获取文件扩展名，确保使用正确的图片格式
-        content_type = response.headers.get('content-type', 'image/jpeg')
-        
-        # 手动映射常见的图片MIME类型到扩展名
-        mime_to_ext = {
-            'image/jpeg': '.jpg',
-            'image/jpg': '.jpg', 
-            'image/png': '.png',
-            'image/gif': '.gif',
-            'image/webp': '.webp',
-            'image/bmp': '.bmp',
-            'image/tiff': '.tiff',
-            'image/svg+xml': '.svg'
-        }
-        
-        extension = mime_to_ext.get(content_type.lower())
-        if not extension:
-            # 如果MIME类型不在映射中，尝试使用mimetypes库
-            extension = mimetypes.guess_extension(content_type)
-            # 如果还是无法获取或者是.bin，默认使用.png
-            if not extension or extension == '.bin':
-                extension = '.png'
-        
-        filename = f"{uuid.uuid4().hex}{extension}"
-        
-        # 上传到 R2
-        r2_client.put_object(
-            Bucket=R2_BUCKET_NAME,
-            Key=filename,
-            Body=BytesIO(response.content),
-            ContentType=content_type
-        )
-        
-        # 构建公共 URL
-        if R2_PUBLIC_URL:
-            # 使用自定义域名或 r2.dev URL
-            public_url = f"{R2_PUBLIC_URL.rstrip('/')}/{filename}"
-        else:
-            # 如果没有配置公共 URL，返回 R2 的默认 URL 格式
-            public_url = f"{R2_ENDPOINT_URL}/{R2_BUCKET_NAME}/{filename}"
-        
-        logging.info(f"图片已成功上传到 R2: {public_url}")
-        return public_url
-        
-    except ClientError as e:
-        logging.error(f"R2 上传失败: {e}")
-        raise
-    except Exception as e:
-        logging.error(f"R2 上传错误: {e}")
-        raise
-
-def upload_image_with_fallback(file_url):
-    """优先使用 R2 上传，失败时回退到 EasyImages"""
-    # 优先尝试 R2
-    if r2_client:
-        try:
-            return upload_image_to_r2(file_url)
-        except Exception as e:
-            logging.warning(f"R2 上传失败，回退到 EasyImages: {e}")
-    
-    # 回退到 EasyImages
-    if EASYIMAGES_API_URL and EASYIMAGES_API_TOKEN:
-        try:
-            return upload_image_to_easyimages(file_url)
-        except Exception as e:
-            logging.error(f"EasyImages 上传也失败: {e}")
-            raise
-    else:
-        raise Exception("没有可用的图片上传服务")
-
 def get_target_session_id(context, thread_id):
-    for session_id, session_data in context.bot_data.items():
-        if session_data.get('topicId') == thread_id:
-            return session_id
-    return None
+    return context.bot_data.get_session_id(thread_id)
 
-def send_markdown_to_client(session_id, markdown_link):
+async def send_markdown_to_client(session_id, markdown_link):
     try:
+        # 回复前先把客户的消息标记为已读
+        await handler.readReceipts.flush(session_id)
         # 将 Markdown 图片链接作为纯文本发送
         query = {
             "type": "text",
@@ -299,7 +176,7 @@ def send_markdown_to_client(session_id, markdown_link):
                 "avatar": "https://bpic.51yuansu.com/pic3/cover/03/47/92/65e3b3b1eb909_800.jpg"
             }
         }
-        client.website.send_message_in_conversation(
+        await crisp.website.send_message_in_conversation(
             config['crisp']['website'],
             session_id,
             query
@@ -313,7 +190,7 @@ async def onChange(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Parses the CallbackQuery and updates the message text."""
     query = update.callback_query
 
-    if openai is None:
+    if clients.openai is None:
         await query.answer('无法设置此功能')
     else:
         data = query.data.split(',')
@@ -321,21 +198,83 @@ async def onChange(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         session["enableAI"] = not eval(data[1])
         await query.answer()
         try:
-             await query.edit_message_reply_markup(changeButton(data[0],session["enableAI"]))
+             # 客服主动操作的按钮，与消息同等优先级
+             await query.edit_message_reply_markup(
+                 handler.changeButton(data[0],session["enableAI"]),
+                 rate_limit_args={'priority': PRIORITY_MESSAGE}
+             )
+             # 卡片上已经是新的按钮，同步卡片哈希，下一条消息不会再做无效的编辑
+             handler.refreshCardHash(data[0], session)
         except Exception as error:
             print(error)
+        handler.persistence.save_session_data(data[0], session)
+
+async def log_ai_stats(context: ContextTypes.DEFAULT_TYPE):
+    """定期输出 AI 调度器的排队情况"""
+    if clients.aiScheduler is None:
+        return
+    stats = clients.aiScheduler.get_stats()
+    logging.info(
+        f"AI 调度统计 - 排队: {stats['queue_depth']}, 进行中: {stats['in_flight']}/{stats['max_in_flight']}, "
+        f"平均等待: {stats['avg_wait']:.3f}s, 最长等待: {stats['max_wait']:.3f}s, "
+        f"完成: {stats['completed']}, 拒绝: {stats['rejected']}, 排队超时: {stats['expired']}, 请求超时: {stats['timed_out']}"
+    )
+    if handler.answerCache is not None:
+        cacheStats = handler.answerCache.get_stats()
+        logging.info(
+            f"回答缓存统计 - 条目: {cacheStats['size']}, 精确命中: {cacheStats['exact_hits']}, "
+            f"语义命中: {cacheStats['semantic_hits']}, 未命中: {cacheStats['misses']}, 命中率: {cacheStats['hit_rate']:.1%}"
+        )
+
+async def log_telegram_stats(context: ContextTypes.DEFAULT_TYPE):
+    """定期输出 Telegram 发送队列的情况"""
+    stats = telegramScheduler.get_stats()
+    logging.info(
+        f"Telegram 发送统计 - 排队: {stats['queued']}, 已发送: {stats['sent']}, "
+        f"平均等待: {stats['avg_wait']:.3f}s, 最长等待: {stats['max_wait']:.3f}s, "
+        f"限流重试: {stats['retried']}, 失败: {stats['failed']}, 编辑超时: {stats['expired']}"
+    )
+
+# Telegram 发送调度：全局与单个群组限流、优先级通道、RetryAfter 自动重试
+rateLimitCfg = config['bot'].get('rate_limit') or {}
+telegramScheduler = TelegramScheduler(rateLimitCfg)
+
+async def shutdown(app: Application):
+    """停止 Bot 时释放连接池等资源"""
+    # 断开 RTM 并停止补发，不再接收新消息，处理完已接收的消息后再关闭连接
+    await handler.sio.disconnect()
+    if handler.catchUpTask is not None:
+        handler.catchUpTask.cancel()
+    await handler.dispatcher.close()
+    await handler.closeReplies()
+    await handler.readReceipts.close()
+    await crisp.close()
+    await imageUploader.close()
+    # 写入全部待保存的会话数据
+    handler.persistence.stop()
 
 def main():
+    webhookCfg = config['bot'].get('webhook') or {}
+    if webhookCfg.get('enabled', False) and not webhookCfg.get('webhook_url'):
+        logging.error('已开启 Webhook 模式，但没有配置 bot.webhook.webhook_url（Telegram 推送更新的公网地址）')
+        exit(1)
+
     try:
-        app = Application.builder().token(config['bot']['token']).defaults(Defaults(parse_mode='HTML')).build()
+        app = (
+            Application.builder()
+            .token(config['bot']['token'])
+            .defaults(Defaults(parse_mode='HTML'))
+            .context_types(ContextTypes(bot_data=SessionMap))
+            .rate_limiter(telegramScheduler)
+            .post_init(bootstrap)
+            .post_shutdown(shutdown)
+            .build()
+        )
         
-        # 加载持久化的会话数据
-        try:
-            persistent_data = handler.persistence.load_session_data()
-            app.bot_data.update(persistent_data)
-            logging.info(f"加载了 {len(persistent_data)} 个持久化会话")
-        except Exception as e:
-            logging.error(f"加载持久化数据失败: {e}")
+        # 会话按需从持久化存储读取，内存中只保留最近使用的会话（仍在处理中的会话除外）
+        cache_size = config.get('persistence', {}).get('cache_size', 10000)
+        app.bot_data.attach(handler.persistence, cache_size, handler.sessionInUse)
+        logging.info(f"会话缓存已启用，内存中最多保留 {cache_size} 个会话")
         
         # 启动 Bot
         if os.getenv('RUNNER_NAME') is not None:
@@ -344,7 +283,11 @@ def main():
         app.add_handler(MessageHandler(filters.TEXT, onReply))
         app.add_handler(MessageHandler(filters.PHOTO | filters.Document.IMAGE, handleImage))
         app.add_handler(CallbackQueryHandler(onChange))
-        app.job_queue.run_once(handler.exec,5,name='RTM')
+        # 每个开启 RTM 的实例都会收到全部 Crisp 消息，多实例部署时只能有一个实例开启
+        if handler.rtmCfg.get('enabled', True):
+            app.job_queue.run_once(handler.exec,0,name='RTM')
+        else:
+            logging.info('RTM 已关闭，本实例只处理 Telegram 更新')
         
         # 设置定期清理过期数据的任务
         cleanup_config = config.get('persistence', {}).get('auto_cleanup', {})
@@ -358,13 +301,39 @@ def main():
             )
             logging.info(f"已设置每 {check_interval_hours} 小时清理一次过期数据")
         
-        # 设置程序退出时强制保存待保存的数据
-        import atexit
-        atexit.register(lambda: handler.persistence.force_save_pending())
+        # 定期输出 AI 调度统计
+        stats_interval = config.get('openai', {}).get('scheduler', {}).get('stats_interval', 300)
+        if clients.aiScheduler is not None and stats_interval:
+            app.job_queue.run_repeating(log_ai_stats, interval=stats_interval, name='ai_stats')
         
-        app.run_polling(drop_pending_updates=True)
+        # 定期输出 Telegram 发送统计
+        telegram_stats_interval = rateLimitCfg.get('stats_interval', 300)
+        if telegram_stats_interval:
+            app.job_queue.run_repeating(log_telegram_stats, interval=telegram_stats_interval, name='telegram_stats')
+        
+        if webhookCfg.get('enabled', False):
+            # Webhook 模式：由内置的 HTTP 服务接收 Telegram 推送的更新
+            if not webhookCfg.get('secret_token'):
+                logging.warning('没有配置 bot.webhook.secret_token，Webhook 不会校验请求来源，任何人都可以伪造更新')
+            logging.info(f"以 Webhook 模式启动，监听 {webhookCfg.get('listen', '0.0.0.0')}:{webhookCfg.get('port', 8443)}")
+            app.run_webhook(
+                listen=webhookCfg.get('listen', '0.0.0.0'),
+                port=webhookCfg.get('port', 8443),
+                url_path=webhookCfg.get('url_path', 'telegram'),
+                webhook_url=webhookCfg['webhook_url'],
+                secret_token=webhookCfg.get('secret_token') or None,
+                cert=webhookCfg.get('cert') or None,
+                key=webhookCfg.get('key') or None,
+                max_connections=webhookCfg.get('max_connections', 40),
+                drop_pending_updates=True
+            )
+        else:
+            app.run_polling(drop_pending_updates=True)
+    except StartupCheckFailed as error:
+        logging.error(str(error))
+        exit(1)
     except Exception as error:
-        logging.warning('无法启动 Telegram Bot，请确认 Bot Token 是否正确，或者是否能连接 Telegram 服务器')
+        logging.warning(f'无法启动 Telegram Bot，请确认 Bot Token 是否正确，或者是否能连接 Telegram 服务器: {error!r}')
         exit(1)
 
 
@@ -0,0 +1,57 @@
+import time
+# 进程启动时间，bot.py 首先导入本模块，启动耗时和首条消息耗时都以此为起点
+startedAt = time.perf_counter()
+
+import yaml
+import logging
+
+from crisp_client import AsyncCrisp
+from ai_scheduler import AIScheduler
+
+# bot.py 作为 __main__ 运行，handler 不能 import bot（否则会再执行一遍 bot.py），
+# 配置和客户端因此放在这个模块中，bot 与 handler 共用同一份实例
+
+# Enable logging
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+# set higher logging level for httpx to avoid all GET and POST requests being logged
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# Load Config
+try:
+    f = open('config.yml', 'r')
+    config = yaml.safe_load(f)
+except FileNotFoundError as error:
+    logging.warning('没有找到 config.yml，请复制 config.yml.example 并重命名为 config.yml')
+    exit(1)
+
+# 消息收发等热路径使用异步客户端，避免阻塞事件循环
+# 连通性检查在启动时由 bootstrap 并发完成，导入模块时不访问网络
+crispCfg = config['crisp']
+crisp = AsyncCrisp(crispCfg['id'], crispCfg['key'], config=crispCfg.get('http'))
+
+# OpenAI 客户端只在配置了 apiKey 时才导入和创建
+openai_config = config.get('openai') or {}
+openai = None
+aiScheduler = None
+if openai_config.get('apiKey'):
+    try:
+        from openai import AsyncOpenAI
+        openai = AsyncOpenAI(
+            api_key=openai_config['apiKey'],
+            base_url=openai_config.get('baseUrl', 'https://api.openai.com/v1')
+        )
+        # 回复生成通过调度器限制并发
+        aiScheduler = AIScheduler(openai, openai_config.get('scheduler'))
+    except Exception as error:
+        logging.warning('无法初始化 OpenAI 客户端，智能化回复将不会使用: ' + str(error))
+        openai = None
+else:
+    logging.info('未配置 OpenAI apiKey，智能化回复将不会使用')
+
+def disableAI():
+    """关闭 AI 回复（OpenAI 不可用时）"""
+    global openai, aiScheduler
+    openai = None
+    aiScheduler = None
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+from typing import Any, Dict, Optional
+
+import httpx
+
+CRISP_API_URL = "https://api.crisp.chat/v1/"
+
+
+class CrispError(Exception):
+    """Crisp REST API 返回错误"""
+
+    def __init__(self, status_code: int, reason: str):
+        super().__init__(f"Crisp API 错误 [{status_code}]: {reason}")
+        self.status_code = status_code
+        self.reason = reason
+
+
+class AsyncCrisp:
+    """基于 httpx 的异步 Crisp REST 客户端
+
+    所有请求共享一个保持长连接的连接池，并通过信号量限制同一主机上的
+    并发请求数，避免阻塞事件循环。接口命名与 crisp_api 保持一致，
+    例如 ``await crisp.website.send_message_in_conversation(...)``。
+    """
+
+    def __init__(self, identifier: str, key: str, tier: str = "plugin",
+                 config: Optional[Dict[str, Any]] = None):
+        config = config or {}
+        self.identifier = identifier
+        self.key = key
+        self.tier = tier
+        self.base_url = config.get('base_url', CRISP_API_URL)
+        self.max_connections = config.get('max_connections', 20)
+        self.max_keepalive = config.get('max_keepalive', 10)
+        self.max_concurrency = config.get('max_concurrency', 10)
+        self.timeout = config.get('timeout', 10)
+        self.connect_timeout = config.get('connect_timeout', 5)
+
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+        self.website = WebsiteResource(self)
+        self.plugin = PluginResource(self)
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # 延迟创建，确保连接池与信号量绑定到实际运行的事件循环
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                auth=(self.identifier, self.key),
+                headers={"X-Crisp-Tier": self.tier},
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive
+                ),
+                timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout)
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._client
+
+    async def request(self, method: str, path: str, params: Optional[Dict[str, Any]] = None,
+                      json: Optional[Dict[str, Any]] = None) -> Any:
+        """发送请求并返回响应中的 data 字段"""
+        client = self._get_client()
+        async with self._semaphore:
+            response = await client.request(method, path, params=params, json=json)
+
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+
+        if response.is_error or body.get('error'):
+            raise CrispError(response.status_code, body.get('reason', response.text))
+        return body.get('data')
+
+    async def close(self):
+        """关闭连接池"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            logging.info("Crisp 连接池已关闭")
+
+
+class WebsiteResource:
+    def __init__(self, parent: AsyncCrisp):
+        self._parent = parent
+
+    async def get_website(self, website_id: str):
+        return await self._parent.request("GET", f"website/{website_id}")
+
+    async def send_message_in_conversation(self, website_id: str, session_id: str, data: Dict[str, Any]):
+        return await self._parent.request(
+            "POST", f"website/{website_id}/conversation/{session_id}/message", json=data)
+
+    async def mark_messages_read_in_conversation(self, website_id: str, session_id: str, data: Dict[str, Any]):
+        return await self._parent.request(
+            "PATCH", f"website/{website_id}/conversation/{session_id}/read", json=data)
+
+    async def list_conversations(self, website_id: str, page_number: int = 1,
+                                 query: Optional[Dict[str, Any]] = None):
+        return await self._parent.request(
+            "GET", f"website/{website_id}/conversations/{page_number}", params=query or None)
+
+    async def compose_message_in_conversation(self, website_id: str, session_id: str, data: Dict[str, Any]):
+        return await self._parent.request(
+            "PATCH", f"website/{website_id}/conversation/{session_id}/compose", json=data)
+
+    async def get_conversation_metas(self, website_id: str, session_id: str):
+        return await self._parent.request(
+            "GET", f"website/{website_id}/conversation/{session_id}/meta")
+
+    async def get_messages_in_conversation(self, website_id: str, session_id: str,
+                                           query: Optional[Dict[str, Any]] = None):
+        return await self._parent.request(
+            "GET", f"website/{website_id}/conversation/{session_id}/messages", params=query or None)
+
+
+class PluginResource:
+    def __init__(self, parent: AsyncCrisp):
+        self._parent = parent
+
+    async def get_connect_account(self):
+        return await self._parent.request("GET", "plugin/connect/account")
+
+    async def get_connect_endpoints(self):
+        return await self._parent.request("GET", "plugin/connect/endpoints")
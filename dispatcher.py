@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, Optional, Tuple
+
+
+class SessionDispatcher:
+    """按会话分片的有序事件分发器
+
+    每个会话有自己的待处理队列，同一会话的事件按到达顺序逐个执行，不同会话
+    之间由固定数量的 worker 并发处理。一个会话在同一时刻只会被一个 worker
+    处理，因此同一访客连续发送的消息不会并发创建重复的话题；缓慢的会话也
+    只会占用一个 worker，不会阻塞其他会话。
+
+    worker 每次只处理一个会话的 burst 个事件，剩余的事件重新排到就绪队列
+    末尾，保证会话之间的公平性。队列处理完后立即回收，空闲会话不占用内存。
+    """
+
+    def __init__(self, workers: int = 8, burst: int = 1, max_pending: int = 0):
+        self.workers = workers
+        self.burst = max(1, burst)
+        self.max_pending = max_pending
+
+        self._queues: Dict[Hashable, Deque[Tuple[Callable[..., Awaitable[Any]], tuple, float]]] = {}
+        self._ready: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._pending = 0
+        self._busy = 0
+        self._closed = False
+
+        # 统计信息
+        self._processed = 0
+        self._failed = 0
+        self._dropped = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._max_depth = 0
+
+    def _start(self):
+        # 延迟创建，确保就绪队列和 worker 绑定到实际运行的事件循环
+        if self._ready is None:
+            self._ready = asyncio.Queue()
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def submit(self, key: Hashable, func: Callable[..., Awaitable[Any]], *args) -> bool:
+        """提交一个事件，同一 key 的事件按提交顺序执行
+
+        待处理事件数超过 max_pending 或分发器已停止时丢弃新事件并返回 False。
+        """
+        if self._closed:
+            self._dropped += 1
+            logging.warning(f"事件分发器已停止，丢弃会话 {key} 的事件")
+            return False
+        if self.max_pending and self._pending >= self.max_pending:
+            self._dropped += 1
+            logging.warning(f"事件分发队列已满 ({self._pending})，丢弃会话 {key} 的事件")
+            return False
+
+        self._start()
+        queue = self._queues.get(key)
+        if queue is None:
+            # 会话当前没有排队或正在处理的事件，放入就绪队列等待 worker
+            queue = self._queues[key] = deque()
+            self._ready.put_nowait(key)
+        queue.append((func, args, time.monotonic()))
+        self._pending += 1
+        self._max_depth = max(self._max_depth, len(queue))
+        return True
+
+    def is_active(self, key: Hashable) -> bool:
+        """会话是否有排队或正在处理的事件"""
+        return key in self._queues
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            queue = self._queues[key]
+            self._busy += 1
+            try:
+                for _ in range(self.burst):
+                    func, args, enqueued_at = queue.popleft()
+                    wait_time = time.monotonic() - enqueued_at
+                    self._total_wait += wait_time
+                    self._max_wait = max(self._max_wait, wait_time)
+                    try:
+                        await func(*args)
+                        self._processed += 1
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        self._failed += 1
+                        logging.exception(f"处理会话 {key} 的事件失败: {e}")
+                    finally:
+                        self._pending -= 1
+                    if not queue:
+                        break
+            finally:
+                self._busy -= 1
+                if queue:
+                    # 还有剩余事件，排到就绪队列末尾，让其他会话先执行
+                    self._ready.put_nowait(key)
+                else:
+                    # 队列已空，回收
+                    del self._queues[key]
+
+    async def join(self, timeout: Optional[float] = None):
+        """等待所有已提交的事件处理完成"""
+        async def drained():
+            while self._pending:
+                await asyncio.sleep(0.05)
+        await asyncio.wait_for(drained(), timeout)
+
+    async def close(self, timeout: Optional[float] = 10):
+        """等待已提交的事件处理完成后停止 worker，之后提交的事件会被丢弃"""
+        self._closed = True
+        if self._ready is None:
+            return
+        try:
+            await self.join(timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"事件分发器停止时仍有 {self._pending} 个事件未处理")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._ready = None
+        self._queues.clear()
+        self._pending = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取分发器统计信息"""
+        started = self._processed + self._failed
+        return {
+            'sessions': len(self._queues),
+            'pending': self._pending,
+            'busy_workers': self._busy,
+            'workers': self.workers,
+            'processed': self._processed,
+            'failed': self._failed,
+            'dropped': self._dropped,
+            'avg_wait': self._total_wait / started if started else 0.0,
+            'max_wait': self._max_wait,
+            'max_depth': self._max_depth
+        }
@@ -1,16 +1,23 @@
 
-import bot
-import json
-import base64
+import time
+import clients
+import asyncio
+import hashlib
 import socketio
-import requests
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 from persistence import SessionPersistence
+from ai_scheduler import AIQueueFull, AIDeadlineExceeded
+from cache import TTLCache
+from keywords import KeywordMatcher
+from tokens import TokenCounter
+from dispatcher import SessionDispatcher
+from receipts import ReadReceiptBatcher
+from answer_cache import AnswerCache
+from telegram_scheduler import PRIORITY_MESSAGE
 
-config = bot.config
-client = bot.client
-openai = bot.openai
-changeButton = bot.changeButton
+config = clients.config
+crisp = clients.crisp
 groupId = config["bot"]["groupId"]
 websiteId = config["crisp"]["website"]
 payload = config["openai"]["payload"]
@@ -18,18 +25,118 @@ payload = config["openai"]["payload"]
 # 初始化持久化管理器
 persistence = SessionPersistence(config)
 
+# 会话元数据缓存，收到 session:set_data 事件时失效
+metasCacheCfg = config["crisp"].get("metas_cache") or {}
+metasCache = TTLCache(
+    ttl=metasCacheCfg.get("ttl", 300),
+    max_size=metasCacheCfg.get("max_size", 10000)
+)
+
+# 每个会话在本地保留的最近对话条数
+historySize = config["openai"].get("history_size", 20)
+
+# token 计数器，编码器在首次使用时加载
+tokenCounter = TokenCounter(
+    config["openai"].get("model", "gpt-3.5-turbo"),
+    context_size=config["openai"].get("context_size")
+)
+
+# 每个会话信息卡片的最短编辑间隔（秒），0 为不限制
+cardEditInterval = config["bot"].get("card_edit_interval", 0)
+cardEdits = TTLCache(ttl=cardEditInterval, max_size=10000)
+
+# 每个会话进行中的信息卡片编辑任务
+cardTasks = {}
+
+# 自动回复关键词在启动时编译为自动机
+keywordMatcher = KeywordMatcher(
+    config.get("autoreply") or {},
+    normalized=config.get("autoreply_normalize", False)
+)
+
+# 合并同一话题短时间内连续的客户消息，window 单位为毫秒，0 为不合并
+coalesceCfg = config["bot"].get("coalesce") or {}
+coalesceWindow = coalesceCfg.get("window", 0)
+coalesceMaxSize = coalesceCfg.get("max_size", 4096)
+recentPosts = TTLCache(ttl=coalesceWindow / 1000, max_size=10000)
+
+# 常见问题的回答缓存，命中时不再调用 AI
+answerCacheCfg = config["openai"].get("answer_cache") or {}
+answerCache = None
+if answerCacheCfg.get("enabled", False) and clients.openai is not None:
+    async def embedQuestion(text):
+        response = await clients.openai.embeddings.create(
+            model=(answerCacheCfg.get("semantic") or {}).get("model", "text-embedding-3-small"),
+            input=text
+        )
+        return response.data[0].embedding
+    answerCache = AnswerCache(answerCacheCfg, embedQuestion)
+
+# 流式回复：生成过程中逐步更新话题中的消息，编辑间隔（秒）受 Telegram 编辑频率限制
+streamCfg = config["openai"].get("stream") or {}
+aiStream = streamCfg.get("enabled", False)
+# 群组发送限额由所有会话共用，流式编辑默认最多占用其中的 1/4，其余留给新消息和信息卡片
+rateLimitCfg = config["bot"].get("rate_limit") or {}
+streamEditInterval = streamCfg.get("edit_interval")
+if streamEditInterval is None:
+    streamEditInterval = 4 * rateLimitCfg.get("chat_period", 60) / rateLimitCfg.get("chat_rate", 20)
+# 每条回复生成期间最多编辑的次数，不含最终写入完整回复的一次
+streamMaxEdits = streamCfg.get("max_edits", 3)
+STREAM_PLACEHOLDER = " ⌛"
+# Telegram 单条消息的最大长度
+MAX_POST_SIZE = 4096
+
+# AI 回复防抖（秒）：窗口内的连续消息只生成一次回复，0 为每条消息单独回复
+aiDebounce = config["openai"].get("debounce", 0)
+aiPending = {}
+# 不防抖时每个会话最后一个排队的 AI 回复任务，同一会话的回复按消息顺序生成
+aiReplies = {}
+
+# 本 Bot 发给客户的消息使用的客服昵称（智能客服为 AI 回复，人工客服为 Telegram 中的回复）
+BOT_NICKNAMES = ('智能客服', '人工客服')
+
+# 已读回执按会话批量发送，不占用消息处理的关键路径
+async def markRead(sessionId, fingerprints):
+    await crisp.website.mark_messages_read_in_conversation(websiteId, sessionId,
+        {"from": "user", "origin": "chat", "fingerprints": fingerprints}
+    )
+
+readReceipts = ReadReceiptBatcher(
+    markRead,
+    delay=(config["crisp"].get("read_receipts") or {}).get("delay", 2)
+)
+
+# RTM 事件按会话分发：同一会话顺序处理，不同会话并发处理
+dispatchCfg = config["crisp"].get("dispatch") or {}
+dispatcher = SessionDispatcher(
+    workers=dispatchCfg.get("workers", 8),
+    burst=dispatchCfg.get("burst", 1),
+    max_pending=dispatchCfg.get("max_pending", 0)
+)
+
+def changeButton(sessionId,boolean):
+    return InlineKeyboardMarkup(
+        [
+            [InlineKeyboardButton(
+                text='关闭 AI 回复' if boolean else '打开 AI 回复',
+                callback_data=f'{sessionId},{boolean}'
+                )
+            ]
+        ]
+    )
+
 def getKey(content: str):
-    if len(config["autoreply"]) > 0:
-        for x in config["autoreply"]:
-            keyword = x.split("|")
-            for key in keyword:
-                if key in content:
-                    return True, config["autoreply"][x]
-    return False, None
+    return keywordMatcher.match(content)
 
-def getMetas(sessionId):
-    metas = client.website.get_conversation_metas(websiteId, sessionId)
+async def getMetas(sessionId):
+    cached = metasCache.get(sessionId)
+    if cached is None:
+        metas = await crisp.website.get_conversation_metas(websiteId, sessionId)
+        cached = {'metas': metas, 'html': renderMetas(metas)}
+        metasCache.set(sessionId, cached)
+    return cached['html']
 
+def renderMetas(metas):
     flow = ['📠<b>Crisp消息推送</b>','']
     
     # 基本用户信息
@@ -145,26 +252,57 @@ def getMetas(sessionId):
     return '无额外信息'
 
 
+def getCardHash(metas, enableAI):
+    return hashlib.sha1(f'{metas}\0{enableAI}'.encode('utf-8')).hexdigest()
+
+def refreshCardHash(sessionId, session):
+    """按钮状态改变后更新信息卡片的哈希，元数据缓存已失效时留到下次编辑卡片时再确定"""
+    cached = metasCache.get(sessionId)
+    if cached is not None:
+        session['cardHash'] = getCardHash(cached['html'], session['enableAI'])
+    else:
+        session.pop('cardHash', None)
+
+def scheduleCardEdit(bot, sessionId, session, metas, newHash):
+    """在后台编辑信息卡片，客户的消息不必等待优先级最低的卡片编辑
+
+    同一会话还在排队的旧编辑已经过时，取消后只发送最新的内容。
+    """
+    previous = cardTasks.get(sessionId)
+    if previous is not None and not previous.done():
+        previous.cancel()
+    task = asyncio.create_task(editCard(bot, sessionId, session, metas, newHash))
+    cardTasks[sessionId] = task
+    task.add_done_callback(lambda done: cardTasks.pop(sessionId) if cardTasks.get(sessionId) is done else None)
+
+async def editCard(bot, sessionId, session, metas, newHash):
+    try:
+        await bot.edit_message_text(
+            metas,
+            groupId,
+            session['messageId'],
+            reply_markup=changeButton(sessionId, session['enableAI'])
+        )
+        session['cardHash'] = newHash
+        print(f"更新现有会话: {sessionId}")
+    except Exception as error:
+        if 'not modified' in str(error):
+            session['cardHash'] = newHash
+        else:
+            print(f"更新信息卡片失败: {error!r}")
+            return
+    persistence.save_session_data(sessionId, session)
+
 async def createSession(data):
     bot = callbackContext.bot
     botData = callbackContext.bot_data
     sessionId = data["session_id"]
+    # 内存中没有会话数据时会自动从持久化存储读取
     session = botData.get(sessionId)
-    
-    # 如果内存中没有会话数据，尝试从持久化存储加载
-    if session is None:
-        try:
-            persistent_data = persistence.load_session_data()
-            if sessionId in persistent_data:
-                session = persistent_data[sessionId]
-                botData[sessionId] = session
-                print(f"从持久化存储恢复会话: {sessionId}")
-        except Exception as e:
-            print(f"加载持久化会话数据失败: {e}")
 
-    metas = getMetas(sessionId)
+    metas = await getMetas(sessionId)
     if session is None:
-        enableAI = False if openai is None else True
+        enableAI = False if clients.openai is None else True
         topic = await bot.create_forum_topic(
             groupId,data["user"]["nickname"])
         msg = await bot.send_message(
@@ -176,7 +314,8 @@ async def createSession(data):
         session_data = {
             'topicId': topic.message_thread_id,
             'messageId': msg.message_id,
-            'enableAI': enableAI
+            'enableAI': enableAI,
+            'cardHash': getCardHash(metas, enableAI)
         }
         botData[sessionId] = session_data
         
@@ -184,18 +323,262 @@ async def createSession(data):
         persistence.save_session_data(sessionId, session_data)
         print(f"创建新会话: {sessionId}")
     else:
+        # 信息卡片内容和按钮没有变化时不再编辑，节省 Telegram API 调用
+        newHash = getCardHash(metas, session['enableAI'])
+        if newHash != session.get('cardHash') and cardEdits.get(sessionId) is None:
+            scheduleCardEdit(bot, sessionId, session, metas, newHash)
+            if cardEditInterval:
+                cardEdits.set(sessionId, True)
+        # 更新会话的最后活动时间
+        persistence.save_session_data(sessionId, session)
+
+async def getHistory(sessionId, session, fingerprints=()):
+    """获取会话最近的对话记录
+
+    优先使用本地缓冲区，只有会话还没有缓冲区时（冷启动）才从 Crisp 拉取一次历史消息。
+    """
+    if "history" not in session:
+        history = []
+        response = await crisp.website.get_messages_in_conversation(websiteId, sessionId, {})
+        # Crisp API直接返回消息数组，不是包含data字段的对象
+        if isinstance(response, list):
+            for msg in response:
+                if (msg.get('type') == 'text' and
+                    isinstance(msg.get('content'), str) and
+                    msg['content'].strip() and
+                    msg.get('fingerprint') not in fingerprints):  # 排除当前消息
+                    role = "assistant" if msg.get('from') == 'operator' else "user"
+                    history.append({"role": role, "content": msg['content'].strip()})
+        session["history"] = history[-historySize:]
+        print(f"从 Crisp 加载了 {len(session['history'])} 条历史消息: {sessionId}")
+    return session["history"]
+
+def recordTurn(sessionId, session, role, content):
+    """将一条消息追加到会话的对话缓冲区（仅在缓冲区已建立时）"""
+    if session is None or "history" not in session or not content or not content.strip():
+        return
+    session["history"] = (session["history"] + [{"role": role, "content": content.strip()}])[-historySize:]
+    persistence.save_session_data(sessionId, session)
+
+async def complete(onDelta=None, **kwargs):
+    """发起一次 AI 请求并返回回复文本，传入 onDelta 时使用流式请求"""
+    if onDelta is not None:
+        return await clients.aiScheduler.stream_completion(onDelta, **kwargs)
+    response = await clients.aiScheduler.create_completion(**kwargs)
+    return response.choices[0].message.content
+
+async def generateReply(sessionId, session, content, fingerprints=(), onDelta=None):
+    """生成 AI 回复，AI 繁忙、超时或请求出错时返回 None，客户的消息照常推送
+
+    会话还没有上下文时先查回答缓存，命中时直接返回缓存的回答。会写入缓存的回答
+    不带用户信息生成，避免把一位客户的信息回答给另一位客户。
+    传入 onDelta 时以流式方式生成，每收到一段内容都以目前为止的文本调用 onDelta。
+    """
+    cacheable = False
+    if answerCache is not None:
         try:
-            await bot.edit_message_text(
-                metas,
-                groupId,
-                session['messageId'],
-                reply_markup=changeButton(sessionId, session['enableAI'])
-            )
-            # 更新会话的最后活动时间
-            persistence.save_session_data(sessionId, session)
-            print(f"更新现有会话: {sessionId}")
-        except Exception as error:
-            print(error)
+            # 会话中已有对话时回答可能依赖上下文，不使用缓存
+            history = await getHistory(sessionId, session, fingerprints)
+            cacheable = len(history) <= answerCache.max_history
+        except Exception as e:
+            print(f"获取历史消息失败，不使用回答缓存: {e}")
+
+    if cacheable:
+        cached = await answerCache.get(content)
+        if cached is not None:
+            print(f"回答缓存命中: {sessionId}")
+            if onDelta is not None:
+                await onDelta(cached)
+            return cached
+
+    try:
+        autoreply = await askAI(sessionId, session, content, fingerprints, onDelta, personalize=not cacheable)
+    except Exception as e:
+        # 包括无上下文模式的重试也失败的情况
+        print(f"AI 回复未能生成: {e!r}")
+        return None
+    if cacheable and autoreply:
+        await answerCache.put(content, autoreply)
+    return autoreply
+
+async def askAI(sessionId, session, content, fingerprints=(), onDelta=None, personalize=True):
+    """调用 OpenAI 生成回复，personalize 为 False 时系统消息中不包含用户信息"""
+    if personalize:
+        # 获取用户元数据信息
+        user_metas = await getMetas(sessionId)
+        # 构建包含用户信息的系统消息
+        enhanced_payload = f"{payload}\n\n## 当前用户信息\n{user_metas}\n\n请根据以上用户信息提供个性化的专业服务。"
+    else:
+        enhanced_payload = payload
+    
+    # 获取历史消息作为上下文
+    try:
+        history = await getHistory(sessionId, session, fingerprints)
+        # 为响应预留1000个token
+        messages, prompt_tokens = tokenCounter.build_messages(
+            enhanced_payload, history[-historySize:], content, reserve=1000)
+        
+        print(f"发送给OpenAI的消息数量: {len(messages)}, 预估token数: {prompt_tokens}")
+        
+        return await complete(onDelta,
+            model=tokenCounter.model,
+            messages=messages,
+            max_tokens=min(300, tokenCounter.context_size - prompt_tokens),  # 客服AI使用较短回复
+            temperature=0.7
+        )
+        
+    except ImportError:
+        print("tiktoken未安装，使用简化的历史消息处理")
+        # 如果tiktoken未安装，使用简化版本
+        history = await getHistory(sessionId, session, fingerprints)
+        messages = [{"role": "system", "content": enhanced_payload}]
+        
+        for msg in history[-5:]:  # 只保留最近5条消息
+            messages.append({"role": msg["role"], "content": msg["content"]})
+        
+        messages.append({"role": "user", "content": content})
+        
+        return await complete(onDelta,
+            model=config['openai'].get('model', 'gpt-3.5-turbo'),
+            messages=messages,
+            max_tokens=300,  # 客服AI使用较短回复
+            temperature=0.7
+        )
+        
+    except (AIQueueFull, AIDeadlineExceeded, asyncio.TimeoutError) as e:
+        # AI 繁忙或超时，仅推送消息，不再重试
+        print(f"AI 回复未能生成: {e!r}")
+        return None
+    except Exception as e:
+        print(f"获取历史消息失败，使用无上下文模式: {e}")
+        # 如果获取历史消息失败，回退到原来的无上下文模式
+        return await complete(onDelta,
+            model=config['openai'].get('model', 'gpt-3.5-turbo'),
+            messages=[
+                {"role": "system", "content": enhanced_payload},
+                {"role": "user", "content": content}
+            ],
+            max_tokens=300,  # 客服AI使用较短回复
+            temperature=0.7
+        )
+
+async def replyToCustomer(sessionId, autoreply):
+    """以智能客服身份将回复发送给客户"""
+    # 回复前先把客户的消息标记为已读
+    await readReceipts.flush(sessionId)
+    query = {
+        "type": "text",
+        "content": autoreply,
+        "from": "operator",
+        "origin": "chat",
+        "user": {
+            "nickname": '智能客服',
+            "avatar": 'https://img.ixintu.com/download/jpg/20210125/8bff784c4e309db867d43785efde1daf_512_512.jpg'
+        }
+    }
+    await crisp.website.send_message_in_conversation(websiteId, sessionId, query)
+
+def scheduleReply(bot, sessionId, session, content, fingerprint):
+    """在防抖窗口结束后为窗口内的全部消息生成一次回复
+
+    窗口内每来一条新消息都会取消尚未发出的回复（包括正在进行的 AI 请求），
+    合并后重新计时。回复已经开始发送时不再取消，新消息进入下一轮。
+    """
+    pending = aiPending.get(sessionId)
+    if pending is not None and not pending["sending"]:
+        pending["task"].cancel()
+        contents = pending["contents"] + [content]
+        fingerprints = pending["fingerprints"] + [fingerprint]
+    else:
+        contents = [content]
+        fingerprints = [fingerprint]
+    pending = {"contents": contents, "fingerprints": fingerprints, "sending": False}
+    pending["task"] = asyncio.create_task(answerLater(bot, sessionId, session, pending))
+    aiPending[sessionId] = pending
+
+async def answerLater(bot, sessionId, session, pending):
+    try:
+        await asyncio.sleep(aiDebounce)
+        content = '\n'.join(pending["contents"])
+        if aiStream:
+            # 流式回复开始推送后不再取消，之后的消息进入下一轮
+            pending["sending"] = True
+            await streamReply(bot, sessionId, session, content, pending["fingerprints"], ['📠<b>消息推送</b>', ''])
+            return
+        autoreply = await generateReply(sessionId, session, content, pending["fingerprints"])
+        pending["sending"] = True
+        if len(pending["contents"]) > 1:
+            print(f"合并 {len(pending['contents'])} 条消息生成一次回复: {sessionId}")
+        
+        if autoreply is not None:
+            await replyToCustomer(sessionId, autoreply)
+        recordTurn(sessionId, session, "user", content)
+        if autoreply is not None:
+            recordTurn(sessionId, session, "assistant", autoreply)
+            await postToTopic(bot, session["topicId"], ['📠<b>消息推送</b>', '', f"💡<b>自动回复</b>：{autoreply}"])
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"AI 回复失败: {e}")
+    finally:
+        if aiPending.get(sessionId) is pending:
+            del aiPending[sessionId]
+
+def queueTurn(sessionId, func, *args):
+    """在会话的回复队列中执行 func(*args)
+
+    同一会话的回复和对话记录等上一项完成后再进行，保证与消息的顺序一致。
+    """
+    task = asyncio.create_task(runTurn(aiReplies.get(sessionId), func, *args))
+    aiReplies[sessionId] = task
+    task.add_done_callback(lambda done: aiReplies.pop(sessionId) if aiReplies.get(sessionId) is done else None)
+
+async def runTurn(previous, func, *args):
+    if previous is not None:
+        await asyncio.gather(previous, return_exceptions=True)
+    try:
+        await func(*args)
+    except Exception as e:
+        print(f"回复客户失败: {e}")
+
+def queueReply(bot, sessionId, session, content, fingerprint, post):
+    """在分发器的 worker 之外生成 AI 回复，慢的 AI 请求不占用 worker，其他会话的消息照常推送
+
+    回复生成后追加到客户消息所在的话题消息（post）中，不额外发送消息。
+    """
+    queueTurn(sessionId, answerNow, bot, sessionId, session, content, [fingerprint], post)
+
+async def answerNow(bot, sessionId, session, content, fingerprints, post):
+    try:
+        if aiStream:
+            await streamReply(bot, sessionId, session, content, fingerprints, ['📠<b>消息推送</b>', ''], post)
+            return
+        autoreply = await generateReply(sessionId, session, content, fingerprints)
+        if autoreply is not None:
+            await replyToCustomer(sessionId, autoreply)
+        recordTurn(sessionId, session, "user", content)
+        if autoreply is not None:
+            recordTurn(sessionId, session, "assistant", autoreply)
+            await appendToPost(bot, session["topicId"], post, [f"💡<b>自动回复</b>：{autoreply}"])
+    except Exception as e:
+        print(f"AI 回复失败: {e}")
+
+def sessionInUse(sessionId):
+    """会话是否仍有进行中的消息处理或 AI 回复，这些会话不会从内存中淘汰"""
+    return (dispatcher.is_active(sessionId) or sessionId in aiReplies
+            or sessionId in aiPending or sessionId in cardTasks)
+
+async def closeReplies(timeout=10):
+    """停止前等待进行中的 AI 回复完成，超时后取消"""
+    tasks = list(aiReplies.values()) + [pending["task"] for pending in aiPending.values()]
+    if not tasks:
+        return
+    done, unfinished = await asyncio.wait(tasks, timeout=timeout)
+    if unfinished:
+        print(f"停止时仍有 {len(unfinished)} 个 AI 回复未完成")
+        for task in unfinished:
+            task.cancel()
+        await asyncio.gather(*unfinished, return_exceptions=True)
 
 async def sendMessage(data):
     bot = callbackContext.bot
@@ -203,9 +586,7 @@ async def sendMessage(data):
     sessionId = data["session_id"]
     session = botData.get(sessionId)
 
-    client.website.mark_messages_read_in_conversation(websiteId,sessionId,
-        {"from": "user", "origin": "chat", "fingerprints": [data["fingerprint"]]}
-    )
+    readReceipts.add(sessionId, data["fingerprint"])
 
     if data["type"] == "text":
         flow = ['📠<b>消息推送</b>','']
@@ -215,156 +596,25 @@ async def sendMessage(data):
         if result is True:
             flow.append("")
             flow.append(f"💡<b>自动回复</b>：{autoreply}")
-        elif openai is not None and session["enableAI"] is True:
-            # 获取用户元数据信息
-            user_metas = getMetas(sessionId)
-            
-            # 获取历史消息作为上下文
-            try:
-                import tiktoken
-                
-                model_name = config['openai'].get('model', 'gpt-3.5-turbo')
-                # 获取对应模型的编码器
-                try:
-                    encoding = tiktoken.encoding_for_model(model_name)
-                except KeyError:
-                    encoding = tiktoken.get_encoding("cl100k_base")  # 默认编码器
-                
-                # 设置token限制（为响应预留空间）
-                max_tokens = 4096 if 'gpt-3.5-turbo' in model_name else 8192
-                max_context_tokens = max_tokens - 1000  # 为响应预留1000个token
-                
-                # 构建包含用户信息的系统消息
-                enhanced_payload = f"{payload}\n\n## 当前用户信息\n{user_metas}\n\n请根据以上用户信息提供个性化的专业服务。"
-                
-                history_response = client.website.get_messages_in_conversation(websiteId, sessionId, {})
-                messages = [{"role": "system", "content": enhanced_payload}]
-                
-                # 计算系统消息的token数
-                current_tokens = len(encoding.encode(enhanced_payload)) + 4  # 4个额外token用于消息格式
-                
-                print(f"历史消息API响应类型: {type(history_response)}, 长度: {len(history_response) if isinstance(history_response, list) else 'N/A'}")
-                
-                # 处理历史消息
-                history_messages = []
-                # Crisp API直接返回消息数组，不是包含data字段的对象
-                if isinstance(history_response, list) and history_response:
-                    print(f"获取到历史消息数量: {len(history_response)}")
-                    
-                    # 过滤并排序历史消息（排除当前消息）
-                    valid_messages = []
-                    current_content = data["content"].strip()
-                    
-                    for msg in history_response:
-                        if (msg.get('type') == 'text' and 
-                            'content' in msg and 
-                            msg['content'].strip() and 
-                            msg['content'].strip() != current_content):  # 排除当前消息
-                            valid_messages.append(msg)
-                    
-                    print(f"有效历史消息数量: {len(valid_messages)}")
-                    
-                    # 按时间顺序处理消息（从最新开始，但插入时保持正确顺序）
-                    for msg in reversed(valid_messages[-20:]):  # 最多取最近20条
-                        role = "assistant" if msg.get('from') == 'operator' else "user"
-                        content = msg['content'].strip()
-                        
-                        # 计算这条消息的token数
-                        msg_tokens = len(encoding.encode(content)) + 4
-                        
-                        # 检查是否超过token限制
-                        if current_tokens + msg_tokens > max_context_tokens:
-                            print(f"Token限制达到，停止添加历史消息")
-                            break
-                        
-                        history_messages.insert(0, {"role": role, "content": content})
-                        current_tokens += msg_tokens
-                        print(f"添加历史消息: {role} - {content[:50]}...")
-                    
-                    messages.extend(history_messages)
-                else:
-                    print("没有获取到历史消息数据或数据格式不正确")
-                
-                # 添加当前用户消息
-                current_msg_tokens = len(encoding.encode(data["content"])) + 4
-                if current_tokens + current_msg_tokens <= max_context_tokens:
-                    messages.append({"role": "user", "content": data["content"]})
-                else:
-                    # 如果当前消息太长，截断历史消息
-                    while len(messages) > 1 and current_tokens + current_msg_tokens > max_context_tokens:
-                        removed_msg = messages.pop(1)  # 保留系统消息，移除最早的历史消息
-                        current_tokens -= len(encoding.encode(removed_msg["content"])) + 4
-                    messages.append({"role": "user", "content": data["content"]})
-                
-                print(f"发送给OpenAI的消息数量: {len(messages)}, 预估token数: {current_tokens + current_msg_tokens}")
-                
-                response = openai.chat.completions.create(
-                    model=model_name,
-                    messages=messages,
-                    max_tokens=min(300, max_tokens - current_tokens - current_msg_tokens),  # 客服AI使用较短回复
-                    temperature=0.7
-                )
-                autoreply = response.choices[0].message.content
-                
-            except ImportError:
-                print("tiktoken未安装，使用简化的历史消息处理")
-                # 如果tiktoken未安装，使用简化版本
-                enhanced_payload = f"{payload}\n\n## 当前用户信息\n{user_metas}\n\n请根据以上用户信息提供个性化的专业服务。"
-                history_response = client.website.get_messages_in_conversation(websiteId, sessionId, {})
-                messages = [{"role": "system", "content": enhanced_payload}]
-                
-                if 'data' in history_response:
-                    recent_messages = history_response['data'][-5:]  # 只保留最近5条消息
-                    for msg in recent_messages:
-                        if msg.get('type') == 'text' and 'content' in msg and msg['content'].strip():
-                            role = "assistant" if msg.get('from') == 'operator' else "user"
-                            messages.append({"role": role, "content": msg['content'].strip()})
-                
-                messages.append({"role": "user", "content": data["content"]})
-                
-                response = openai.chat.completions.create(
-                    model=config['openai'].get('model', 'gpt-3.5-turbo'),
-                    messages=messages,
-                    max_tokens=300,  # 客服AI使用较短回复
-                    temperature=0.7
-                )
-                autoreply = response.choices[0].message.content
-                
-            except Exception as e:
-                print(f"获取历史消息失败，使用无上下文模式: {e}")
-                # 如果获取历史消息失败，回退到原来的无上下文模式
-                enhanced_payload = f"{payload}\n\n## 当前用户信息\n{user_metas}\n\n请根据以上用户信息提供个性化的专业服务。"
-                response = openai.chat.completions.create(
-                    model=config['openai'].get('model', 'gpt-3.5-turbo'),
-                    messages=[
-                        {"role": "system", "content": enhanced_payload},
-                        {"role": "user", "content": data["content"]}
-                    ],
-                    max_tokens=300,  # 客服AI使用较短回复
-                    temperature=0.7
-                )
-                autoreply = response.choices[0].message.content
-            flow.append("")
-            flow.append(f"💡<b>自动回复</b>：{autoreply}")
+        elif clients.openai is not None and session["enableAI"] is True:
+            # 先推送客户的消息，回复在 worker 之外单独生成，本轮对话也在那时记录
+            post = await postToTopic(bot, session["topicId"], flow)
+            if aiDebounce:
+                scheduleReply(bot, sessionId, session, data["content"], data["fingerprint"])
+            else:
+                queueReply(bot, sessionId, session, data["content"], data["fingerprint"], post)
+            return
         
-        if autoreply is not None:
-            query = {
-                "type": "text",
-                "content": autoreply,
-                "from": "operator",
-                "origin": "chat",
-                "user": {
-                    "nickname": '智能客服',
-                    "avatar": 'https://img.ixintu.com/download/jpg/20210125/8bff784c4e309db867d43785efde1daf_512_512.jpg'
-                }
-            }
-            client.website.send_message_in_conversation(websiteId, sessionId, query)
-        await bot.send_message(
-            groupId,
-            '\n'.join(flow),
-            message_thread_id=session["topicId"]
-        )
+        if sessionId in aiReplies:
+            # 之前的 AI 回复还没有完成，关键词回复和对话记录排在它之后
+            queueTurn(sessionId, finishTurn, sessionId, session, data["content"], autoreply)
+        else:
+            await finishTurn(sessionId, session, data["content"], autoreply)
+        
+        await postToTopic(bot, session["topicId"], flow)
     elif data["type"] == "file" and str(data["content"]["type"]).count("image") > 0:
+        # 图片之后的文字消息不再合并到图片之前的消息中
+        recentPosts.pop(session["topicId"])
         await bot.send_photo(
             groupId,
             data["content"]["url"],
@@ -373,7 +623,164 @@ async def sendMessage(data):
     else:
         print("Unhandled Message Type : ", data["type"])
 
-sio = socketio.AsyncClient(reconnection_attempts=5, logger=True)
+async def finishTurn(sessionId, session, content, autoreply):
+    """发送关键词回复（如果有），并记录本轮对话，供后续 AI 回复作为上下文"""
+    if autoreply is not None:
+        await replyToCustomer(sessionId, autoreply)
+    recordTurn(sessionId, session, "user", content)
+    if autoreply is not None:
+        recordTurn(sessionId, session, "assistant", autoreply)
+
+async def postToTopic(bot, topicId, flow):
+    """推送消息到话题，窗口内的连续消息合并为一条（编辑上一条消息）"""
+    if coalesceWindow:
+        recent = recentPosts.get(topicId)
+        if recent is not None:
+            text = recent["text"] + '\n\n' + '\n'.join(flow[2:])
+            if len(text) <= coalesceMaxSize:
+                try:
+                    await bot.edit_message_text(
+                        text,
+                        groupId,
+                        recent["messageId"],
+                        rate_limit_args={'priority': PRIORITY_MESSAGE}
+                    )
+                    # 原地更新，持有这条消息的回复任务能看到合并后的内容
+                    recent["text"] = text
+                    recentPosts.set(topicId, recent)
+                    return recent
+                except Exception as error:
+                    # 上一条消息无法编辑（如已被删除）时发送新消息
+                    print(f"合并消息失败，发送新消息: {error}")
+
+    text = '\n'.join(flow)
+    msg = await bot.send_message(
+        groupId,
+        text,
+        message_thread_id=topicId
+    )
+    post = {"messageId": msg.message_id, "text": text}
+    if coalesceWindow:
+        recentPosts.set(topicId, post)
+    return post
+
+async def appendToPost(bot, topicId, post, lines):
+    """在已推送的话题消息末尾追加内容，消息过长或无法编辑时发送新消息"""
+    text = post["text"] + '\n\n' + '\n'.join(lines)
+    if len(text) <= MAX_POST_SIZE:
+        try:
+            await bot.edit_message_text(
+                text,
+                groupId,
+                post["messageId"],
+                rate_limit_args={'priority': PRIORITY_MESSAGE}
+            )
+            post["text"] = text
+            return post
+        except Exception as error:
+            print(f"追加到话题消息失败，发送新消息: {error}")
+    return await postToTopic(bot, topicId, ['📠<b>消息推送</b>', ''] + lines)
+
+async def setTyping(sessionId, typing):
+    """在 Crisp 中显示或取消客服正在输入的状态"""
+    try:
+        await crisp.website.compose_message_in_conversation(websiteId, sessionId,
+            {"type": "start" if typing else "stop", "from": "operator"}
+        )
+    except Exception as error:
+        print(f"更新输入状态失败: {error}")
+
+async def streamReply(bot, sessionId, session, content, fingerprints, flow, post=None):
+    """流式生成 AI 回复
+
+    生成期间在 Crisp 显示输入状态，话题中的消息随生成进度按 streamEditInterval 节流更新
+    （最多 streamMaxEdits 次），
+    生成完成后把完整回复发送给客户并记录本轮对话。传入 post 时回复写在这条已推送的
+    客户消息末尾，否则推送一条新消息。
+    """
+    asyncio.create_task(setTyping(sessionId, True))
+    if post is not None and len(post["text"]) < MAX_POST_SIZE // 2:
+        prefix = post["text"] + '\n\n💡<b>自动回复</b>：'
+    else:
+        lines = flow + ([""] if len(flow) > 2 else []) + [f"💡<b>自动回复</b>：{STREAM_PLACEHOLDER}"]
+        post = await postToTopic(bot, session["topicId"], lines)
+        prefix = post["text"][:-len(STREAM_PLACEHOLDER)]
+    # 回复生成期间客户的新消息不再合并到这条消息中
+    recentPosts.pop(session["topicId"])
+    # 从发出消息开始计时，第一次编辑前已经有一段可见的回复
+    lastEdit = time.monotonic()
+    edits = 0
+    editing = None
+
+    async def onDelta(text):
+        nonlocal lastEdit, edits, editing
+        now = time.monotonic()
+        # 同一时间最多一个进行中的编辑，不阻塞流的读取
+        if (edits >= streamMaxEdits or now - lastEdit < streamEditInterval
+                or (editing is not None and not editing.done())):
+            return
+        lastEdit = now
+        edits += 1
+        editing = asyncio.create_task(editPost(bot, post, prefix + text + STREAM_PLACEHOLDER))
+
+    autoreply = None
+    try:
+        autoreply = await generateReply(sessionId, session, content, fingerprints, onDelta)
+    finally:
+        if editing is not None:
+            await asyncio.gather(editing, return_exceptions=True)
+        if autoreply is None:
+            asyncio.create_task(setTyping(sessionId, False))
+        # 去掉占位符，写入最终回复
+        await editPost(bot, post, prefix + (autoreply if autoreply is not None else "未能生成"), PRIORITY_MESSAGE)
+
+    if autoreply is not None:
+        await replyToCustomer(sessionId, autoreply)
+    recordTurn(sessionId, session, "user", content)
+    if autoreply is not None:
+        recordTurn(sessionId, session, "assistant", autoreply)
+
+async def editPost(bot, post, text, priority=None):
+    try:
+        await bot.edit_message_text(
+            text,
+            groupId,
+            post["messageId"],
+            rate_limit_args={'priority': priority} if priority is not None else None
+        )
+        post["text"] = text
+    except Exception as error:
+        if 'not modified' not in str(error):
+            print(f"更新流式回复失败: {error}")
+
+# RTM 断线后按指数退避无限重连，重连后补发断线期间的消息
+rtmCfg = config["crisp"].get("rtm") or {}
+reconnectDelay = rtmCfg.get("reconnect_delay", 1)
+reconnectDelayMax = rtmCfg.get("reconnect_delay_max", 60)
+sio = socketio.AsyncClient(
+    reconnection=True,
+    reconnection_attempts=0,  # 0 为不限制重连次数
+    reconnection_delay=reconnectDelay,
+    reconnection_delay_max=reconnectDelayMax,
+    randomization_factor=0.5,
+    logger=True
+)
+
+# 已处理消息的指纹，补发时与实时推送的消息去重
+seenFingerprints = TTLCache(ttl=rtmCfg.get("dedup_ttl", 3600), max_size=50000)
+# 补发起点（毫秒），持久化保存，重启后从这里开始补发
+checkpoint = persistence.get_state("rtm_last_handled_at")
+# 最后处理完成的客户消息时间（毫秒）
+lastHandledAt = checkpoint
+# 最后收到的客户消息时间（毫秒），重连后从这里开始补发
+lastEventAt = checkpoint
+# 已收到但尚未处理完成的客户消息：时间（毫秒） -> 条数
+inFlight = {}
+catchUpConcurrency = rtmCfg.get("catch_up_concurrency", 4)
+catchUpMaxPages = rtmCfg.get("catch_up_max_pages", 5)
+catchUpTask = None
+rtmConnected = False
+
 # Def Event Handlers
 @sio.on("connect")
 async def connect():
@@ -383,8 +790,12 @@ async def connect():
         "password": config["crisp"]["key"],
         "events": [
             "message:send",
+            "message:received",
             "session:set_data"
         ]})
+    # 首次连接后的补发由 exec 发起，这里只处理重连
+    if rtmConnected:
+        startCatchUp()
 @sio.on("unauthorized")
 async def unauthorized(data):
     print('Unauthorized: ', data)
@@ -398,30 +809,156 @@ async def disconnect():
 async def messageForward(data):
     if data["website_id"] != websiteId:
         return
-    await createSession(data)
-    await sendMessage(data)
+    if not acceptMessage(data):
+        return
+    dispatcher.submit(data["session_id"], handleMessage, data)
+
+def acceptMessage(data):
+    """登记收到的消息，已经处理过的消息返回 False"""
+    global lastEventAt
+    fingerprint = data.get("fingerprint")
+    if fingerprint is not None:
+        if seenFingerprints.get(fingerprint) is not None:
+            return False
+        seenFingerprints.set(fingerprint, True)
+    timestamp = data.get("timestamp")
+    if timestamp is not None:
+        # 处理完成前一直占住补发起点，补发的旧消息可能比已处理的消息更早
+        inFlight[timestamp] = inFlight.get(timestamp, 0) + 1
+        saveCheckpoint()
+    lastEventAt = max(lastEventAt or 0, timestamp or int(time.time() * 1000))
+    return True
+
+def releaseMessage(timestamp):
+    """消息处理结束（包括处理失败），补发起点可以越过它"""
+    global lastHandledAt
+    if timestamp is None:
+        return
+    count = inFlight.get(timestamp, 0) - 1
+    if count > 0:
+        inFlight[timestamp] = count
+    else:
+        inFlight.pop(timestamp, None)
+    lastHandledAt = max(lastHandledAt or 0, timestamp)
+    saveCheckpoint()
+
+def saveCheckpoint():
+    """持久化补发起点：有未处理完成的消息时取其中最早的一条之前，否则取最后处理完成的消息
+
+    分发队列已满或分发器停止时丢弃的消息不会被释放，重启后会从它们之前开始补发。
+    """
+    global checkpoint
+    value = min(inFlight) - 1 if inFlight else lastHandledAt
+    if value is not None and value != checkpoint:
+        checkpoint = value
+        persistence.set_state("rtm_last_handled_at", value)
+
+def startCatchUp():
+    """从 lastEventAt 开始补发，同一时间只运行一次补发"""
+    global catchUpTask
+    if lastEventAt is None or (catchUpTask is not None and not catchUpTask.done()):
+        return
+    catchUpTask = asyncio.create_task(catchUp(lastEventAt))
+
+async def catchUp(since):
+    """补发断线期间未读会话中的客户消息"""
+    try:
+        sessionIds = []
+        for page in range(1, catchUpMaxPages + 1):
+            conversations = await crisp.website.list_conversations(websiteId, page, {"filter_unread": 1})
+            if not conversations:
+                break
+            # 会话按更新时间倒序排列，遇到断线前的会话即可停止
+            fresh = [c["session_id"] for c in conversations if c.get("updated_at", 0) > since]
+            sessionIds.extend(fresh)
+            if len(fresh) < len(conversations):
+                break
+
+        semaphore = asyncio.Semaphore(catchUpConcurrency)
+        async def replay(sessionId):
+            async with semaphore:
+                messages = await crisp.website.get_messages_in_conversation(websiteId, sessionId, {})
+            replayed = 0
+            for msg in messages or []:
+                if msg.get("from") != "user" or msg.get("timestamp", 0) <= since:
+                    continue
+                msg.setdefault("website_id", websiteId)
+                msg.setdefault("session_id", sessionId)
+                if acceptMessage(msg):
+                    dispatcher.submit(sessionId, handleMessage, msg)
+                    replayed += 1
+            return replayed
+
+        results = await asyncio.gather(*(replay(sessionId) for sessionId in sessionIds), return_exceptions=True)
+        replayed = sum(result for result in results if isinstance(result, int))
+        failed = sum(1 for result in results if isinstance(result, BaseException))
+        print(f"断线补发完成: {len(sessionIds)} 个会话, 补发 {replayed} 条消息, 失败 {failed} 个会话")
+    except Exception as error:
+        print(f"断线补发失败: {error}")
+
+firstMessageHandled = False
+
+async def handleMessage(data):
+    global firstMessageHandled
+    try:
+        # 会话数据写入跟不上时先等待后台写入，不阻塞事件循环
+        await persistence.wait_for_backlog()
+        await createSession(data)
+        await sendMessage(data)
+    except asyncio.CancelledError:
+        # 分发器停止时被取消的消息不释放，重启后重新补发
+        raise
+    except Exception:
+        releaseMessage(data.get("timestamp"))
+        raise
+    releaseMessage(data.get("timestamp"))
+    if not firstMessageHandled:
+        firstMessageHandled = True
+        print(f"首条消息处理完成，距启动 {time.perf_counter() - clients.startedAt:.3f}s")
+
+@sio.on("message:received")
+async def recordOperatorMessage(data):
+    """记录客服在 Crisp 后台发送的回复，供后续 AI 回复作为上下文"""
+    if data["website_id"] != websiteId:
+        return
+    if data.get("from") != "operator" or data.get("type") != "text":
+        return
+    # 本 Bot 发出的回复在发送时已经记录
+    if (data.get("user") or {}).get("nickname") in BOT_NICKNAMES:
+        return
+    session = callbackContext.bot_data.get(data["session_id"])
+    recordTurn(data["session_id"], session, "assistant", data.get("content"))
+
+@sio.on("session:set_data")
+async def invalidateMetas(data):
+    if data["website_id"] != websiteId:
+        return
+    metasCache.pop(data["session_id"])
 
 # Meow!
-def getCrispConnectEndpoints():
-    url = "https://api.crisp.chat/v1/plugin/connect/endpoints"
-
-    authtier = base64.b64encode(
-        (config["crisp"]["id"] + ":" + config["crisp"]["key"]).encode("utf-8")
-    ).decode("utf-8")
-    payload = ""
-    headers = {"X-Crisp-Tier": "plugin", "Authorization": "Basic " + authtier}
-    response = requests.request("GET", url, headers=headers, data=payload)
-    endPoint = json.loads(response.text).get("data").get("socket").get("app")
-    return endPoint
+async def getCrispConnectEndpoints():
+    endpoints = await crisp.plugin.get_connect_endpoints()
+    return endpoints.get("socket").get("app")
 
 # Connecting to Crisp RTM(WSS) Server
 async def exec(context: ContextTypes.DEFAULT_TYPE):
-    global callbackContext
+    global callbackContext, rtmConnected
     callbackContext = context
-    # await sendAllUnread()
-    await sio.connect(
-        getCrispConnectEndpoints(),
-        transports="websocket",
-        wait_timeout=10,
-    )
+    # 首次连接失败时同样按指数退避重试，连接建立后由 socketio 负责重连
+    delay = reconnectDelay
+    while True:
+        try:
+            await sio.connect(
+                await getCrispConnectEndpoints(),
+                transports="websocket",
+                wait_timeout=10,
+            )
+            break
+        except Exception as error:
+            print(f"连接 Crisp RTM 失败，{delay} 秒后重试: {error}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, reconnectDelayMax)
+    rtmConnected = True
+    # 补发上次停止（或崩溃）后未处理的消息
+    startCatchUp()
     await sio.wait()
\ No newline at end of file
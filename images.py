@@ -0,0 +1,280 @@
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import httpx
+
+# 常见图片 MIME 类型到扩展名的映射
+MIME_TO_EXT = {
+    'image/jpeg': '.jpg',
+    'image/jpg': '.jpg',
+    'image/png': '.png',
+    'image/gif': '.gif',
+    'image/webp': '.webp',
+    'image/bmp': '.bmp',
+    'image/tiff': '.tiff',
+    'image/svg+xml': '.svg'
+}
+
+
+def guess_extension(content_type: str) -> str:
+    """根据 MIME 类型获取图片扩展名，无法识别时默认使用 .png"""
+    extension = MIME_TO_EXT.get(content_type.lower())
+    if not extension:
+        # 如果MIME类型不在映射中，尝试使用mimetypes库
+        extension = mimetypes.guess_extension(content_type)
+        # 如果还是无法获取或者是.bin，默认使用.png
+        if not extension or extension == '.bin':
+            extension = '.png'
+    return extension
+
+
+class ImageCache:
+    """已上传图片的本地缓存
+
+    以图片内容的 SHA-256 和 Telegram 的 file_unique_id 为键记录已上传的公开 URL，
+    保存在 SQLite 中，超过 max_entries 时淘汰最久未使用的记录。数据库读写在线程池中
+    执行，不阻塞事件循环。
+    """
+
+    def __init__(self, data_file: str = 'image_cache.db', max_entries: int = 10000):
+        self.data_file = data_file
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(data_file, check_same_thread=False)
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS images (
+                cache_key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                last_used REAL NOT NULL
+            )
+        ''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_images_last_used ON images (last_used)')
+        self._conn.commit()
+
+    async def get(self, cache_key: str) -> Optional[str]:
+        url = await asyncio.to_thread(self._get, cache_key)
+        if url is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return url
+
+    async def put(self, url: str, *cache_keys: str):
+        await asyncio.to_thread(self._put, url, *cache_keys)
+
+    def _get(self, cache_key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute('SELECT url FROM images WHERE cache_key = ?', (cache_key,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute('UPDATE images SET last_used = ? WHERE cache_key = ?', (time.time(), cache_key))
+            self._conn.commit()
+            return row[0]
+
+    def _put(self, url: str, *cache_keys: str):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO images (cache_key, url, last_used) VALUES (?, ?, ?)',
+                [(cache_key, url, now) for cache_key in cache_keys if cache_key]
+            )
+            # 淘汰最久未使用的记录
+            self._conn.execute('''
+                DELETE FROM images WHERE cache_key IN (
+                    SELECT cache_key FROM images ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )
+            ''', (self.max_entries,))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ImageUploader:
+    """异步图片转存
+
+    从 Telegram 分块下载图片到临时文件（小文件留在内存，超过 spool_size 写入磁盘），
+    再上传到 Cloudflare R2（大文件自动分片上传），失败时回退到 EasyImages。
+    下载和 EasyImages 上传共享一个连接池，同时进行的转存数受 max_concurrency 限制。
+    """
+
+    def __init__(self, config: Dict[str, Any]):
+        easyimages = config.get('easyimages') or {}
+        self.easyimages_url = easyimages.get('apiUrl', '')
+        self.easyimages_token = easyimages.get('apiToken', '')
+
+        r2 = config.get('cloudflare_r2') or {}
+        self.r2_endpoint_url = r2.get('endpoint_url', '')
+        self.r2_bucket_name = r2.get('bucket_name', '')
+        self.r2_public_url = r2.get('public_url', '')
+
+        upload = config.get('image_upload') or {}
+        self.max_concurrency = upload.get('max_concurrency', 4)
+        self.chunk_size = upload.get('chunk_size', 64 * 1024)
+        self.spool_size = upload.get('spool_size', 1024 * 1024)
+        self.timeout = upload.get('timeout', 60)
+        self.multipart_threshold = upload.get('multipart_threshold', 8 * 1024 * 1024)
+
+        self._http: Optional[httpx.AsyncClient] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+        # 已上传图片缓存，重复发送的图片无需再次下载和上传
+        cache = upload.get('cache') or {}
+        self.cache = None
+        if cache.get('enabled', True):
+            # 默认与会话数据放在同一目录（Docker 中为挂载的 data 目录），重建容器后缓存仍然有效
+            session_file = (config.get('persistence') or {}).get('data_file', 'session_data.db')
+            self.cache = ImageCache(
+                cache.get('data_file') or os.path.join(os.path.dirname(session_file), 'image_cache.db'),
+                cache.get('max_entries', 10000)
+            )
+
+        # 初始化 R2 客户端
+        self.r2_client = None
+        self._transfer_config = None
+        if self.r2_endpoint_url and r2.get('access_key_id') and r2.get('secret_access_key') and self.r2_bucket_name:
+            try:
+                import boto3
+                from boto3.s3.transfer import TransferConfig
+                self.r2_client = boto3.client(
+                    's3',
+                    endpoint_url=self.r2_endpoint_url,
+                    aws_access_key_id=r2['access_key_id'],
+                    aws_secret_access_key=r2['secret_access_key'],
+                    region_name='auto'  # R2 使用 'auto' 作为区域
+                )
+                self._transfer_config = TransferConfig(
+                    multipart_threshold=self.multipart_threshold,
+                    multipart_chunksize=self.multipart_threshold
+                )
+                logging.info('Cloudflare R2 客户端初始化成功')
+            except Exception as e:
+                logging.warning(f'Cloudflare R2 客户端初始化失败: {e}')
+                self.r2_client = None
+        else:
+            logging.info('Cloudflare R2 配置不完整，将仅使用 EasyImages')
+
+    def _get_http(self) -> httpx.AsyncClient:
+        # 延迟创建，确保连接池与信号量绑定到实际运行的事件循环
+        if self._http is None:
+            self._http = httpx.AsyncClient(timeout=self.timeout, follow_redirects=True)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._http
+
+    async def lookup(self, file_unique_id: Optional[str]) -> Optional[str]:
+        """按 Telegram file_unique_id 查找已上传的图片 URL"""
+        if self.cache is None or not file_unique_id:
+            return None
+        return await self.cache.get(f"tg:{file_unique_id}")
+
+    async def upload(self, file_url: str, file_unique_id: Optional[str] = None) -> str:
+        """转存图片并返回公开访问的 URL（优先 R2，失败时回退到 EasyImages）"""
+        cached_url = await self.lookup(file_unique_id)
+        if cached_url:
+            return cached_url
+
+        http = self._get_http()
+        async with self._semaphore:
+            with tempfile.SpooledTemporaryFile(max_size=self.spool_size) as spool:
+                content_type, digest = await self._download(http, file_url, spool)
+
+                # 相同内容的图片已经上传过，直接复用
+                content_key = f"sha256:{digest}"
+                if self.cache is not None:
+                    cached_url = await self.cache.get(content_key)
+                    if cached_url:
+                        await self.cache.put(cached_url, f"tg:{file_unique_id}" if file_unique_id else None)
+                        return cached_url
+
+                uploaded_url = await self._upload(http, spool, content_type, digest)
+
+        if self.cache is not None:
+            await self.cache.put(uploaded_url, content_key, f"tg:{file_unique_id}" if file_unique_id else None)
+        return uploaded_url
+
+    async def _upload(self, http: httpx.AsyncClient, spool, content_type: str, digest: str) -> str:
+        # 优先尝试 R2
+        if self.r2_client:
+            try:
+                spool.seek(0)
+                return await self._upload_to_r2(spool, content_type, digest)
+            except Exception as e:
+                logging.warning(f"R2 上传失败，回退到 EasyImages: {e}")
+
+        # 回退到 EasyImages
+        if self.easyimages_url and self.easyimages_token:
+            try:
+                spool.seek(0)
+                return await self._upload_to_easyimages(http, spool, content_type)
+            except Exception as e:
+                logging.error(f"EasyImages 上传也失败: {e}")
+                raise
+        raise Exception("没有可用的图片上传服务")
+
+    async def _download(self, http: httpx.AsyncClient, file_url: str, spool) -> Tuple[str, str]:
+        """分块下载文件到临时文件，返回 (Content-Type, 内容的 SHA-256)"""
+        sha256 = hashlib.sha256()
+        async with http.stream('GET', file_url) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(self.chunk_size):
+                sha256.update(chunk)
+                spool.write(chunk)
+            return response.headers.get('content-type', 'image/jpeg'), sha256.hexdigest()
+
+    async def _upload_to_r2(self, spool, content_type: str, digest: str) -> str:
+        """上传图片到 Cloudflare R2，对象名由内容哈希决定"""
+        filename = f"{digest}{guess_extension(content_type)}"
+
+        # boto3 为同步接口，放到线程池中执行，大文件自动使用分片上传
+        await asyncio.to_thread(
+            self.r2_client.upload_fileobj,
+            spool,
+            self.r2_bucket_name,
+            filename,
+            ExtraArgs={'ContentType': content_type},
+            Config=self._transfer_config
+        )
+
+        # 构建公共 URL
+        if self.r2_public_url:
+            # 使用自定义域名或 r2.dev URL
+            public_url = f"{self.r2_public_url.rstrip('/')}/{filename}"
+        else:
+            # 如果没有配置公共 URL，返回 R2 的默认 URL 格式
+            public_url = f"{self.r2_endpoint_url}/{self.r2_bucket_name}/{filename}"
+
+        logging.info(f"图片已成功上传到 R2: {public_url}")
+        return public_url
+
+    async def _upload_to_easyimages(self, http: httpx.AsyncClient, spool, content_type: str) -> str:
+        """上传图片到 EasyImages"""
+        response = await http.post(
+            self.easyimages_url,
+            files={'image': ('image' + guess_extension(content_type), spool, content_type)},
+            data={'token': self.easyimages_token}
+        )
+        res_data = response.json()
+
+        if res_data.get("result") == "success":
+            return res_data["url"]
+        raise Exception(f"Image upload failed: {res_data}")
+
+    async def close(self):
+        """关闭连接池和缓存"""
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
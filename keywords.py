@@ -0,0 +1,106 @@
+import unicodedata
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
+
+
+def normalize(text: str) -> str:
+    """统一全角/半角和大小写，便于中英文关键词匹配"""
+    return unicodedata.normalize('NFKC', text).casefold()
+
+
+class KeywordMatcher:
+    """基于 Aho–Corasick 自动机的多关键词匹配器
+
+    autoreply 配置在启动（或重新加载配置）时编译一次，之后每条消息只需
+    线性扫描一遍。多个规则同时命中时，配置中靠前的规则优先，与逐条匹配的
+    旧行为保持一致。
+    """
+
+    def __init__(self, autoreply: Optional[Dict[str, Any]] = None, normalized: bool = False):
+        self.normalized = normalized
+        self._replies: List[Any] = []
+        # 状态转移表、失败指针，以及每个状态命中的最小规则序号
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[Optional[int]] = [None]
+        self.compile(autoreply or {})
+
+    def compile(self, autoreply: Dict[str, Any]):
+        """编译 autoreply 配置，键为用 | 分隔的关键词，值为回复内容"""
+        self._replies = []
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [None]
+
+        for priority, (keys, reply) in enumerate(autoreply.items()):
+            self._replies.append(reply)
+            for key in str(keys).split('|'):
+                if self.normalized:
+                    key = normalize(key)
+                if key:
+                    self._add(key, priority)
+                else:
+                    # 空关键词匹配任何消息，与 `'' in content` 的旧行为一致
+                    self._set_output(0, priority)
+
+        self._build()
+
+    def _add(self, key: str, priority: int):
+        state = 0
+        for char in key:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(None)
+            state = next_state
+        self._set_output(state, priority)
+
+    def _set_output(self, state: int, priority: Optional[int]):
+        if priority is None:
+            return
+        current = self._output[state]
+        if current is None or priority < current:
+            self._output[state] = priority
+
+    def _build(self):
+        # 广度优先计算失败指针，并把后缀状态的输出合并进来
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(char, 0)
+                self._fail[next_state] = target if target != next_state else 0
+                self._set_output(next_state, self._output[self._fail[next_state]])
+
+    def match(self, content: str) -> Tuple[bool, Any]:
+        """返回 (是否命中, 回复内容)"""
+        if not self._replies:
+            return False, None
+        if self.normalized:
+            content = normalize(content)
+
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        best = output[0]
+        state = 0
+        for char in content:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            priority = output[state]
+            if priority is not None and (best is None or priority < best):
+                best = priority
+                if best == 0:
+                    break
+
+        if best is None:
+            return False, None
+        return True, self._replies[best]
@@ -0,0 +1,205 @@
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+
+class LogStore:
+    """追加写日志存储
+
+    每次写入只把变更的会话以紧凑 JSON 行追加到日志文件末尾，启动时按顺序重放
+    日志重建内存中的数据。被覆盖或删除的旧记录超过阈值后，在后台线程中把当前
+    数据写入临时文件并原子替换原日志（压缩）。
+
+    日志格式（每行一条记录）::
+
+        {"k": "session_id", "v": {...}}   写入/覆盖
+        {"k": "session_id", "d": 1}       删除
+    """
+
+    def __init__(self, path: str, fsync: bool = False, compact_ratio: float = 1.0,
+                 compact_min: int = 1000):
+        self.path = path
+        self.fsync = fsync
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+
+        self._data: Dict[str, Dict[str, Any]] = {}
+        self._topics: Dict[Any, str] = {}
+        self._records = 0
+        self._lock = threading.RLock()
+        self._compacting = False
+        self._compact_buffer: List[str] = []
+        self.compactions = 0
+
+        self._replay()
+        self._file = open(self.path, 'a', encoding='utf-8')
+        if self._has_torn_tail():
+            # 补上换行，避免新记录接在写了一半的行后面
+            self._file.write('\n')
+            self._file.flush()
+
+    def _has_torn_tail(self) -> bool:
+        with open(self.path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() == 0:
+                return False
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) != b'\n'
+
+    def _replay(self):
+        """重放日志，重建内存数据"""
+        if not os.path.exists(self.path):
+            return
+
+        corrupted = 0
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    key = record['k']
+                except (ValueError, KeyError, TypeError):
+                    # 崩溃时可能留下写了一半的最后一行，跳过即可
+                    corrupted += 1
+                    continue
+                self._records += 1
+                if record.get('d'):
+                    self._remove(key)
+                else:
+                    self._set(key, record['v'])
+
+        if corrupted:
+            logging.warning(f"日志 {self.path} 中有 {corrupted} 行无法解析，已跳过")
+        logging.info(f"日志重放完成: {len(self._data)} 条有效数据, {self._records} 条记录")
+
+    def _set(self, key: str, value: Dict[str, Any]):
+        old = self._data.get(key)
+        if old is not None and self._topics.get(old.get('topicId')) == key:
+            del self._topics[old.get('topicId')]
+        self._data[key] = value
+        if value.get('topicId') is not None:
+            self._topics[value['topicId']] = key
+
+    def _remove(self, key: str):
+        old = self._data.pop(key, None)
+        if old is not None and self._topics.get(old.get('topicId')) == key:
+            del self._topics[old.get('topicId')]
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._data.get(key)
+
+    def find_by_topic(self, topic_id: Any) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+        with self._lock:
+            key = self._topics.get(topic_id)
+            return (key, self._data[key]) if key is not None else (None, None)
+
+    def items(self) -> List[Tuple[str, Dict[str, Any]]]:
+        with self._lock:
+            return list(self._data.items())
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def put_many(self, items: Dict[str, Dict[str, Any]]):
+        """写入多条数据，只追加变更的记录"""
+        lines = []
+        with self._lock:
+            for key, value in items.items():
+                self._set(key, value)
+                lines.append(json.dumps({'k': key, 'v': value}, ensure_ascii=False, separators=(',', ':')))
+            self._append(lines)
+        self.maybe_compact()
+
+    def delete_many(self, keys: Iterable[str]):
+        """删除多条数据"""
+        lines = []
+        with self._lock:
+            for key in keys:
+                if key in self._data:
+                    self._remove(key)
+                    lines.append(json.dumps({'k': key, 'd': 1}, ensure_ascii=False, separators=(',', ':')))
+            self._append(lines)
+        self.maybe_compact()
+
+    def _append(self, lines: List[str]):
+        if not lines:
+            return
+        payload = '\n'.join(lines) + '\n'
+        self._file.write(payload)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._records += len(lines)
+        if self._compacting:
+            # 压缩进行中，新记录同时写入缓冲区，替换日志前补写到新文件
+            self._compact_buffer.append(payload)
+
+    @property
+    def garbage(self) -> int:
+        """已被覆盖或删除的记录数"""
+        return self._records - len(self._data)
+
+    def maybe_compact(self):
+        """垃圾记录超过阈值时在后台线程中压缩日志"""
+        with self._lock:
+            if self._compacting:
+                return
+            if self.garbage < self.compact_min or self.garbage < self.compact_ratio * len(self._data):
+                return
+            self._compacting = True
+        threading.Thread(target=self._compact, daemon=True).start()
+
+    def compact(self):
+        """同步压缩日志"""
+        with self._lock:
+            if self._compacting:
+                return
+            self._compacting = True
+        self._compact()
+
+    def _compact(self):
+        tmp_path = self.path + '.compact'
+        try:
+            with self._lock:
+                snapshot = list(self._data.items())
+                self._compact_buffer = []
+
+            # 写入快照时不持有锁，新的写入照常追加到旧日志和缓冲区
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for key, value in snapshot:
+                    f.write(json.dumps({'k': key, 'v': value}, ensure_ascii=False, separators=(',', ':')))
+                    f.write('\n')
+                f.flush()
+
+                with self._lock:
+                    for payload in self._compact_buffer:
+                        f.write(payload)
+                    f.flush()
+                    os.fsync(f.fileno())
+
+                    # 原子替换，崩溃时要么是旧日志要么是完整的新日志
+                    self._file.close()
+                    os.replace(tmp_path, self.path)
+                    self._file = open(self.path, 'a', encoding='utf-8')
+                    self._records = len(snapshot) + sum(p.count('\n') for p in self._compact_buffer)
+                    self._compact_buffer = []
+                    self.compactions += 1
+            logging.info(f"日志压缩完成: {self.path}, 当前 {self._records} 条记录")
+        except Exception as e:
+            logging.error(f"日志压缩失败: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            with self._lock:
+                if self._file is not None and self._file.closed:
+                    self._file = open(self.path, 'a', encoding='utf-8')
+        finally:
+            with self._lock:
+                self._compacting = False
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -1,13 +1,20 @@
 import json
+import heapq
 import sqlite3
 import asyncio
 import threading
+import time
 from datetime import datetime, timedelta
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Tuple
 import logging
 import os
 
+from logstore import LogStore
+
 class SessionPersistence:
+    # SQLite 中会话数据对应的列（不含 last_updated）
+    SQLITE_COLUMNS = 'session_id, topic_id, message_id, enable_ai, card_hash, history'
+    
     def __init__(self, config: Dict[str, Any]):
         self.config = config.get('persistence', {})
         self.storage_type = self.config.get('storage_type', 'json')
@@ -19,11 +26,45 @@ class SessionPersistence:
         self.async_enabled = self.async_config.get('enabled', True)
         self.batch_interval = self.async_config.get('batch_interval', 30)
         self.max_batch_size = self.async_config.get('max_batch_size', 100)
+        # 待保存数量达到该值时立即写入，不等待 batch_interval
+        self.flush_threshold = self.async_config.get('flush_threshold', self.max_batch_size)
+        # 待保存数量超过该值时，新消息在处理前最多等待 backpressure_timeout 秒（见 wait_for_backlog）
+        self.max_backlog = self.async_config.get('max_backlog', 10000)
+        self.backpressure_timeout = self.async_config.get('backpressure_timeout', 1)
         
-        # 内存中的待保存数据
+        # 内存中的待保存数据，以及正在写入存储的数据
         self._pending_saves = {}
-        self._save_lock = threading.Lock()
+        self._flushing = {}
+        self._save_lock = threading.Condition()
+        self._flush_mutex = threading.Lock()
         self._save_task = None
+        self._stopping = False
+        
+        # 写入统计
+        self._flush_stats = {
+            'flush_count': 0,
+            'flushed_items': 0,
+            'last_flush_size': 0,
+            'last_flush_latency': 0.0,
+            'max_flush_latency': 0.0,
+            'backpressure_waits': 0,
+            'failed_items': 0
+        }
+        
+        # SQLite 长连接，后台保存线程与事件循环共用，由锁串行化访问
+        self.sqlite_config = self.config.get('sqlite', {})
+        self._conn: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.RLock()
+        
+        # 追加写日志存储（storage_type 为 log 时使用）
+        self._log: Optional[LogStore] = None
+        self._expiry_heap: List[Tuple[str, str]] = []
+        
+        # 运行状态（如 RTM 最后处理的消息时间）保存在单独的小文件中，与存储类型无关
+        self.state_file = self.config.get('state_file', f'{self.data_file}.state')
+        self._state_lock = threading.Lock()
+        self._state: Dict[str, Any] = self._load_state()
+        self._state_dirty = False
         
         # 初始化存储
         self._init_storage()
@@ -36,24 +77,81 @@ class SessionPersistence:
         """初始化存储系统"""
         if self.storage_type == 'sqlite':
             self._init_sqlite()
+        elif self.storage_type == 'log':
+            self._init_log()
         elif self.storage_type == 'json':
             self._init_json()
     
     def _init_sqlite(self):
         """初始化SQLite数据库"""
-        conn = sqlite3.connect(self.data_file)
-        cursor = conn.cursor()
+        self._conn = sqlite3.connect(
+            self.data_file,
+            check_same_thread=False,
+            timeout=self.sqlite_config.get('busy_timeout', 5)
+        )
+        # WAL 模式下读写互不阻塞，NORMAL 同步级别在 WAL 下仍可保证数据库一致性
+        self._conn.execute(f"PRAGMA journal_mode = {self.sqlite_config.get('journal_mode', 'WAL')}")
+        self._conn.execute(f"PRAGMA synchronous = {self.sqlite_config.get('synchronous', 'NORMAL')}")
+        
+        with self._db_lock, self._conn:
+            self._create_sqlite_schema(self._conn.cursor())
+    
+    def _create_sqlite_schema(self, cursor: sqlite3.Cursor):
+        """创建表结构并迁移旧版本数据库"""
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS sessions (
                 session_id TEXT PRIMARY KEY,
                 topic_id INTEGER,
                 message_id INTEGER,
                 enable_ai BOOLEAN,
+                card_hash TEXT,
+                history TEXT,
                 last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
-        conn.commit()
-        conn.close()
+        
+        # 旧版本数据库缺少的列
+        cursor.execute('PRAGMA table_info(sessions)')
+        columns = {row[1] for row in cursor.fetchall()}
+        for column, column_type in (('card_hash', 'TEXT'), ('history', 'TEXT')):
+            if column not in columns:
+                cursor.execute(f'ALTER TABLE sessions ADD COLUMN {column} {column_type}')
+        
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_topic_id ON sessions (topic_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_last_updated ON sessions (last_updated)')
+        
+        # 统一时间格式为 ISO 8601，旧版本写入的 CURRENT_TIMESTAMP 使用空格分隔
+        cursor.execute('''
+            UPDATE sessions SET last_updated = replace(last_updated, ' ', 'T')
+            WHERE last_updated LIKE '____-__-__ %'
+        ''')
+    
+    def _init_log(self):
+        """初始化追加写日志存储"""
+        log_config = self.config.get('log', {})
+        self._log = LogStore(
+            self.data_file,
+            fsync=log_config.get('fsync', False),
+            compact_ratio=log_config.get('compact_ratio', 1.0),
+            compact_min=log_config.get('compact_min', 1000)
+        )
+        self._rebuild_expiry_heap()
+    
+    def _rebuild_expiry_heap(self):
+        """按最后活动时间建立最小堆，过期清理只需弹出堆顶"""
+        with self._db_lock:
+            self._expiry_heap = [
+                (session_data.get('last_updated', ''), session_id)
+                for session_id, session_data in self._log.items()
+            ]
+            heapq.heapify(self._expiry_heap)
+    
+    def _log_put(self, items: Dict[str, Any]):
+        """写入日志存储并登记过期时间"""
+        self._log.put_many(items)
+        with self._db_lock:
+            for session_id, session_data in items.items():
+                heapq.heappush(self._expiry_heap, (session_data.get('last_updated', ''), session_id))
     
     def _init_json(self):
         """初始化JSON文件"""
@@ -66,6 +164,8 @@ class SessionPersistence:
         try:
             if self.storage_type == 'sqlite':
                 return self._load_from_sqlite()
+            elif self.storage_type == 'log':
+                return self._load_from_log()
             else:
                 return self._load_from_json()
         except Exception as e:
@@ -74,30 +174,122 @@ class SessionPersistence:
     
     def _load_from_sqlite(self) -> Dict[str, Any]:
         """从SQLite加载数据"""
-        conn = sqlite3.connect(self.data_file)
-        cursor = conn.cursor()
-        
-        # 删除过期数据
-        expire_date = datetime.now() - timedelta(days=self.expire_days)
-        cursor.execute('DELETE FROM sessions WHERE last_updated < ?', (expire_date,))
-        
-        # 加载有效数据
-        cursor.execute('SELECT session_id, topic_id, message_id, enable_ai FROM sessions')
-        rows = cursor.fetchall()
+        with self._db_lock, self._conn:
+            cursor = self._conn.cursor()
+            
+            # 删除过期数据
+            cursor.execute('DELETE FROM sessions WHERE last_updated < ?', (self._expire_cutoff(),))
+            
+            # 加载有效数据
+            cursor.execute(f'SELECT {self.SQLITE_COLUMNS} FROM sessions')
+            rows = cursor.fetchall()
         
         data = {}
         for row in rows:
-            session_id, topic_id, message_id, enable_ai = row
-            data[session_id] = {
-                'topicId': topic_id,
-                'messageId': message_id,
-                'enableAI': bool(enable_ai)
-            }
-        
-        conn.commit()
-        conn.close()
+            data[row[0]] = self._row_to_session(row)
         return data
     
+    def _load_from_log(self) -> Dict[str, Any]:
+        """从日志存储加载数据"""
+        self._clean_expired_log()
+        return {session_id: self._strip_timestamp(session_data) for session_id, session_data in self._log.items()}
+    
+    def get_session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """按会话 ID 读取单个会话，不存在时返回 None"""
+        with self._save_lock:
+            pending = self._pending_saves.get(session_id) or self._flushing.get(session_id)
+        if pending is not None:
+            return self._strip_timestamp(pending)
+        
+        try:
+            if self.storage_type == 'sqlite':
+                return self._get_from_sqlite('session_id = ?', session_id)[1]
+            elif self.storage_type == 'log':
+                session_data = self._log.get(session_id)
+                return self._strip_timestamp(session_data) if session_data else None
+            else:
+                data = self._read_json()
+                session_data = data.get(session_id)
+                return self._strip_timestamp(session_data) if session_data else None
+        except Exception as e:
+            logging.error(f"读取会话 {session_id} 失败: {e}")
+            return None
+    
+    def get_session_by_topic(self, topic_id: int) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+        """按 Telegram 话题 ID 读取单个会话，返回 (session_id, session_data)"""
+        with self._save_lock:
+            for queue in (self._pending_saves, self._flushing):
+                for session_id, pending in queue.items():
+                    if pending.get('topicId') == topic_id:
+                        return session_id, self._strip_timestamp(pending)
+        
+        try:
+            if self.storage_type == 'sqlite':
+                return self._get_from_sqlite('topic_id = ?', topic_id)
+            elif self.storage_type == 'log':
+                session_id, session_data = self._log.find_by_topic(topic_id)
+                return session_id, self._strip_timestamp(session_data) if session_data else None
+            else:
+                for session_id, session_data in self._read_json().items():
+                    if session_data.get('topicId') == topic_id:
+                        return session_id, self._strip_timestamp(session_data)
+                return None, None
+        except Exception as e:
+            logging.error(f"按话题 {topic_id} 读取会话失败: {e}")
+            return None, None
+    
+    def _get_from_sqlite(self, where: str, value: Any) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+        """从SQLite按索引列读取一条会话"""
+        with self._db_lock:
+            row = self._conn.execute(
+                f'SELECT {self.SQLITE_COLUMNS} FROM sessions WHERE {where} LIMIT 1',
+                (value,)
+            ).fetchone()
+        
+        if row is None:
+            return None, None
+        return row[0], self._row_to_session(row)
+    
+    @staticmethod
+    def _row_to_session(row) -> Dict[str, Any]:
+        """将SQLite查询结果转换为会话数据"""
+        _, topic_id, message_id, enable_ai, card_hash, history = row
+        session_data = {
+            'topicId': topic_id,
+            'messageId': message_id,
+            'enableAI': bool(enable_ai)
+        }
+        if card_hash:
+            session_data['cardHash'] = card_hash
+        if history is not None:
+            session_data['history'] = json.loads(history)
+        return session_data
+    
+    @staticmethod
+    def _session_to_row(session_id: str, session_data: Dict[str, Any]) -> tuple:
+        """将会话数据转换为SQLite写入参数（不含时间戳）"""
+        return (
+            session_id,
+            session_data.get('topicId'),
+            session_data.get('messageId'),
+            session_data.get('enableAI', False),
+            session_data.get('cardHash'),
+            json.dumps(session_data['history'], ensure_ascii=False) if 'history' in session_data else None
+        )
+    
+    def _read_json(self) -> Dict[str, Any]:
+        """读取JSON文件中的全部数据（不做清理和回写）"""
+        try:
+            with open(self.data_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+    
+    @staticmethod
+    def _strip_timestamp(session_data: Dict[str, Any]) -> Dict[str, Any]:
+        """移除内部使用的时间戳字段，保持原有格式"""
+        return {k: v for k, v in session_data.items() if k != 'last_updated'}
+    
     def _load_from_json(self) -> Dict[str, Any]:
         """从JSON文件加载数据"""
         try:
@@ -125,6 +317,46 @@ class SessionPersistence:
         except FileNotFoundError:
             return {}
     
+    def _load_state(self) -> Dict[str, Any]:
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logging.error(f"加载运行状态失败: {e}")
+            return {}
+    
+    def get_state(self, key: str, default: Any = None) -> Any:
+        """读取持久化的运行状态"""
+        with self._state_lock:
+            return self._state.get(key, default)
+    
+    def set_state(self, key: str, value: Any):
+        """更新运行状态，异步保存时随下一次批量写入保存"""
+        with self._state_lock:
+            self._state[key] = value
+            self._state_dirty = True
+        if not self.async_enabled:
+            self._save_state()
+    
+    def _save_state(self):
+        """写入运行状态（先写临时文件再替换，避免写到一半时文件损坏）"""
+        with self._state_lock:
+            if not self._state_dirty:
+                return
+            state = dict(self._state)
+            self._state_dirty = False
+        try:
+            tmp_file = f'{self.state_file}.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(state, f)
+            os.replace(tmp_file, self.state_file)
+        except Exception as e:
+            logging.error(f"保存运行状态失败: {e}")
+            with self._state_lock:
+                self._state_dirty = True
+    
     def save_session_data(self, session_id: str, session_data: Dict[str, Any]):
         """保存会话数据"""
         if self.async_enabled:
@@ -133,18 +365,37 @@ class SessionPersistence:
             self._save_immediately(session_id, session_data)
     
     def _queue_for_async_save(self, session_id: str, session_data: Dict[str, Any]):
-        """将数据加入异步保存队列"""
+        """将数据加入异步保存队列，只入队和唤醒后台线程，不会阻塞调用方"""
         with self._save_lock:
             self._pending_saves[session_id] = {
                 **session_data,
                 'last_updated': datetime.now().isoformat()
             }
+            if len(self._pending_saves) >= min(self.flush_threshold, self.max_backlog):
+                self._save_lock.notify_all()
+    
+    async def wait_for_backlog(self):
+        """积压超过 max_backlog 时异步等待后台线程写入，最多等待 backpressure_timeout 秒
+        
+        在事件循环中处理新消息之前调用，等待期间不阻塞事件循环；超时后照常处理，不丢弃数据。
+        """
+        if not self.async_enabled or len(self._pending_saves) < self.max_backlog:
+            return
+        self._flush_stats['backpressure_waits'] += 1
+        deadline = time.monotonic() + self.backpressure_timeout
+        while len(self._pending_saves) >= self.max_backlog:
+            if time.monotonic() >= deadline:
+                logging.warning(f"待保存数据积压 {len(self._pending_saves)} 条，写入速度跟不上")
+                return
+            await asyncio.sleep(0.05)
     
     def _save_immediately(self, session_id: str, session_data: Dict[str, Any]):
         """立即保存数据"""
         try:
             if self.storage_type == 'sqlite':
                 self._save_to_sqlite(session_id, session_data)
+            elif self.storage_type == 'log':
+                self._log_put({session_id: {**session_data, 'last_updated': datetime.now().isoformat()}})
             else:
                 # 对于JSON，需要加载全部数据再保存
                 all_data = self._load_from_json()
@@ -155,22 +406,12 @@ class SessionPersistence:
     
     def _save_to_sqlite(self, session_id: str, session_data: Dict[str, Any]):
         """保存到SQLite"""
-        conn = sqlite3.connect(self.data_file)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT OR REPLACE INTO sessions 
-            (session_id, topic_id, message_id, enable_ai, last_updated)
-            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
-        ''', (
-            session_id,
-            session_data.get('topicId'),
-            session_data.get('messageId'),
-            session_data.get('enableAI', False)
-        ))
-        
-        conn.commit()
-        conn.close()
+        with self._db_lock, self._conn:
+            self._conn.execute(f'''
+                INSERT OR REPLACE INTO sessions 
+                ({self.SQLITE_COLUMNS}, last_updated)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', self._session_to_row(session_id, session_data) + (datetime.now().isoformat(),))
     
     def _save_to_json_sync(self, all_data: Dict[str, Any]):
         """同步保存到JSON文件"""
@@ -190,62 +431,102 @@ class SessionPersistence:
         def save_worker():
             while True:
                 try:
-                    # 等待指定间隔
-                    threading.Event().wait(self.batch_interval)
-                    
-                    # 获取待保存的数据
+                    # 等待间隔到期、待保存数量达到阈值或收到停止信号
                     with self._save_lock:
-                        if not self._pending_saves:
-                            continue
-                        
-                        # 限制批量大小
-                        items_to_save = dict(list(self._pending_saves.items())[:self.max_batch_size])
-                        
-                        # 清空已处理的项目
-                        for session_id in items_to_save.keys():
-                            del self._pending_saves[session_id]
+                        self._save_lock.wait_for(
+                            lambda: (self._stopping
+                                     or len(self._pending_saves) >= self.flush_threshold
+                                     or len(self._pending_saves) >= self.max_backlog),
+                            timeout=self.batch_interval
+                        )
+                        stopping = self._stopping
+                    
+                    # 写入全部积压数据
+                    failed = self._flush_pending()
                     
-                    # 批量保存
-                    if items_to_save:
-                        self._batch_save(items_to_save)
-                        
+                    if stopping:
+                        return
+                    if failed:
+                        # 写入失败的数据已放回队列，稍后重试，避免存储持续出错时空转
+                        with self._save_lock:
+                            self._save_lock.wait_for(lambda: self._stopping, timeout=min(self.batch_interval, 5))
                 except Exception as e:
                     logging.error(f"异步保存任务错误: {e}")
         
         # 启动后台线程
-        save_thread = threading.Thread(target=save_worker, daemon=True)
-        save_thread.start()
+        self._save_task = threading.Thread(target=save_worker, name='persistence-flusher', daemon=True)
+        self._save_task.start()
     
-    def _batch_save(self, items_to_save: Dict[str, Any]):
-        """批量保存数据"""
+    def _flush_pending(self) -> int:
+        """按 max_batch_size 分批写入所有待保存的数据和运行状态，返回写入失败的条数"""
+        with self._flush_mutex:
+            failed = self._flush_pending_locked()
+            self._save_state()
+            return failed
+    
+    def _flush_pending_locked(self) -> int:
+        with self._save_lock:
+            if not self._pending_saves:
+                return 0
+            self._flushing = self._pending_saves
+            self._pending_saves = {}
+            # 积压已清空，唤醒因背压等待的保存请求
+            self._save_lock.notify_all()
+        
+        start = time.monotonic()
+        items = list(self._flushing.items())
+        failed = {}
+        try:
+            for i in range(0, len(items), self.max_batch_size):
+                batch = dict(items[i:i + self.max_batch_size])
+                if not self._batch_save(batch):
+                    failed.update(batch)
+        finally:
+            latency = time.monotonic() - start
+            with self._save_lock:
+                # 写入失败的数据放回队列等待重试，期间已有更新的数据时以新数据为准
+                for session_id, session_data in failed.items():
+                    self._pending_saves.setdefault(session_id, session_data)
+                self._flushing = {}
+                stats = self._flush_stats
+                stats['failed_items'] += len(failed)
+                stats['flush_count'] += 1
+                stats['flushed_items'] += len(items)
+                stats['last_flush_size'] = len(items)
+                stats['last_flush_latency'] = latency
+                stats['max_flush_latency'] = max(stats['max_flush_latency'], latency)
+            logging.debug(f"写入 {len(items)} 条会话数据，耗时 {latency:.3f}s")
+        return len(failed)
+    
+    def _batch_save(self, items_to_save: Dict[str, Any]) -> bool:
+        """批量保存数据，失败时返回 False"""
         try:
             if self.storage_type == 'sqlite':
                 self._batch_save_sqlite(items_to_save)
+            elif self.storage_type == 'log':
+                self._log_put(items_to_save)
             else:
                 self._batch_save_json(items_to_save)
+            return True
         except Exception as e:
-            logging.error(f"批量保存失败: {e}")
+            logging.error(f"批量保存失败，{len(items_to_save)} 条数据将重试: {e}")
+            return False
     
     def _batch_save_sqlite(self, items_to_save: Dict[str, Any]):
-        """批量保存到SQLite"""
-        conn = sqlite3.connect(self.data_file)
-        cursor = conn.cursor()
+        """批量保存到SQLite（单个事务）"""
+        rows = [
+            self._session_to_row(session_id, session_data) + (
+                session_data.get('last_updated', datetime.now().isoformat()),
+            )
+            for session_id, session_data in items_to_save.items()
+        ]
         
-        for session_id, session_data in items_to_save.items():
-            cursor.execute('''
+        with self._db_lock, self._conn:
+            self._conn.executemany(f'''
                 INSERT OR REPLACE INTO sessions 
-                (session_id, topic_id, message_id, enable_ai, last_updated)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (
-                session_id,
-                session_data.get('topicId'),
-                session_data.get('messageId'),
-                session_data.get('enableAI', False),
-                session_data.get('last_updated', datetime.now().isoformat())
-            ))
-        
-        conn.commit()
-        conn.close()
+                ({self.SQLITE_COLUMNS}, last_updated)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
     
     def _batch_save_json(self, items_to_save: Dict[str, Any]):
         """批量保存到JSON"""
@@ -263,31 +544,65 @@ class SessionPersistence:
         with open(self.data_file, 'w', encoding='utf-8') as f:
             json.dump(all_data, f, ensure_ascii=False, indent=2)
     
-    def clean_expired_data(self):
-        """清理过期数据"""
+    def clean_expired_data(self) -> List[str]:
+        """清理过期数据，返回被清理的会话ID"""
         try:
             if self.storage_type == 'sqlite':
-                self._clean_expired_sqlite()
+                expired = self._clean_expired_sqlite()
+            elif self.storage_type == 'log':
+                expired = self._clean_expired_log()
             else:
-                self._clean_expired_json()
+                expired = self._clean_expired_json()
             logging.info("过期数据清理完成")
         except Exception as e:
             logging.error(f"清理过期数据失败: {e}")
-    
-    def _clean_expired_sqlite(self):
-        """清理SQLite中的过期数据"""
-        conn = sqlite3.connect(self.data_file)
-        cursor = conn.cursor()
+            return []
         
-        expire_date = datetime.now() - timedelta(days=self.expire_days)
-        cursor.execute('DELETE FROM sessions WHERE last_updated < ?', (expire_date,))
+        # 仍在保存队列中的会话有新的活动，不算过期
+        with self._save_lock:
+            return [
+                session_id for session_id in expired
+                if session_id not in self._pending_saves and session_id not in self._flushing
+            ]
+    
+    def _expire_cutoff(self) -> str:
+        """过期时间点（ISO 8601 字符串，可直接与 last_updated 比较）"""
+        return (datetime.now() - timedelta(days=self.expire_days)).isoformat()
+    
+    def _clean_expired_sqlite(self) -> List[str]:
+        """清理SQLite中的过期数据（通过 last_updated 索引只访问过期的行）"""
+        cutoff = self._expire_cutoff()
+        with self._db_lock, self._conn:
+            expired = [
+                row[0] for row in
+                self._conn.execute('SELECT session_id FROM sessions WHERE last_updated < ?', (cutoff,))
+            ]
+            if expired:
+                self._conn.execute('DELETE FROM sessions WHERE last_updated < ?', (cutoff,))
         
-        deleted_count = cursor.rowcount
-        conn.commit()
-        conn.close()
+        if expired:
+            logging.info(f"清理了 {len(expired)} 条过期会话数据")
+        return expired
+    
+    def _clean_expired_log(self) -> List[str]:
+        """清理日志存储中的过期数据（追加删除记录）"""
+        cutoff = self._expire_cutoff()
+        expired = []
+        with self._db_lock:
+            while self._expiry_heap and self._expiry_heap[0][0] < cutoff:
+                last_updated, session_id = heapq.heappop(self._expiry_heap)
+                session_data = self._log.get(session_id)
+                # 堆中可能残留已被更新的旧时间戳，只有与当前数据一致的才算过期
+                if session_data is not None and session_data.get('last_updated', '') == last_updated:
+                    expired.append(session_id)
+            
+            if len(self._expiry_heap) > 2 * len(self._log) + 1000:
+                self._rebuild_expiry_heap()
         
-        if deleted_count > 0:
-            logging.info(f"清理了 {deleted_count} 条过期会话数据")
+        self._log.delete_many(expired)
+        if expired:
+            logging.info(f"清理了 {len(expired)} 条过期会话数据")
+        return expired
     
     def _clean_expired_json(self):
         """清理JSON中的过期数据"""
@@ -295,11 +610,11 @@ class SessionPersistence:
             with open(self.data_file, 'r', encoding='utf-8') as f:
                 data = json.load(f)
         except (FileNotFoundError, json.JSONDecodeError):
-            return
+            return []
         
         expire_date = datetime.now() - timedelta(days=self.expire_days)
         valid_data = {}
-        deleted_count = 0
+        expired = []
         
         for session_id, session_data in data.items():
             last_updated_str = session_data.get('last_updated')
@@ -309,7 +624,7 @@ class SessionPersistence:
                     if last_updated > expire_date:
                         valid_data[session_id] = session_data
                     else:
-                        deleted_count += 1
+                        expired.append(session_id)
                 except ValueError:
                     # 如果时间格式有问题，保留数据但添加新的时间戳
                     session_data['last_updated'] = datetime.now().isoformat()
@@ -319,17 +634,32 @@ class SessionPersistence:
                 session_data['last_updated'] = datetime.now().isoformat()
                 valid_data[session_id] = session_data
         
-        if deleted_count > 0:
+        if expired:
             with open(self.data_file, 'w', encoding='utf-8') as f:
                 json.dump(valid_data, f, ensure_ascii=False, indent=2)
-            logging.info(f"清理了 {deleted_count} 条过期会话数据")
+            logging.info(f"清理了 {len(expired)} 条过期会话数据")
+        return expired
     
     def force_save_pending(self):
         """强制保存所有待保存的数据"""
-        with self._save_lock:
-            if self._pending_saves:
-                self._batch_save(self._pending_saves.copy())
-                self._pending_saves.clear()
+        self._flush_pending()
+    
+    def stop(self, timeout: Optional[float] = None):
+        """停止后台保存线程，写入全部待保存数据后关闭存储"""
+        if self._save_task is not None:
+            with self._save_lock:
+                self._stopping = True
+                self._save_lock.notify_all()
+            self._save_task.join(timeout)
+            self._save_task = None
+        # 后台线程未启用或未能在超时内退出时，在当前线程写入剩余数据
+        if self._flush_pending():
+            # 再重试一次，仍然失败时数据无法保存，记录下来
+            time.sleep(1)
+            failed = self._flush_pending()
+            if failed:
+                logging.error(f"停止时仍有 {failed} 条会话数据写入失败，这些修改将丢失")
+        self.close()
     
     def get_stats(self) -> Dict[str, Any]:
         """获取存储统计信息"""
@@ -342,13 +672,14 @@ class SessionPersistence:
         
         if self.storage_type == 'sqlite':
             try:
-                conn = sqlite3.connect(self.data_file)
-                cursor = conn.cursor()
-                cursor.execute('SELECT COUNT(*) FROM sessions')
-                stats['total_sessions'] = cursor.fetchone()[0]
-                conn.close()
+                with self._db_lock:
+                    stats['total_sessions'] = self._conn.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
             except Exception:
                 stats['total_sessions'] = 0
+        elif self.storage_type == 'log':
+            stats['total_sessions'] = len(self._log)
+            stats['log_garbage'] = self._log.garbage
+            stats['log_compactions'] = self._log.compactions
         else:
             try:
                 with open(self.data_file, 'r', encoding='utf-8') as f:
@@ -359,5 +690,16 @@ class SessionPersistence:
         
         with self._save_lock:
             stats['pending_saves'] = len(self._pending_saves)
+            stats['flushing'] = len(self._flushing)
+            stats.update(self._flush_stats)
         
-        return stats
\ No newline at end of file
+        return stats
+    
+    def close(self):
+        """关闭数据库连接"""
+        with self._db_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        if self._log is not None:
+            self._log.close()
@@ -0,0 +1,60 @@
+"""向本地运行的 Webhook 发送录制的 Telegram Update，用于本地测试
+
+用法:
+    python post_update.py update.json [更多文件...]
+    python post_update.py --url http://127.0.0.1:8443/telegram updates.jsonl
+
+文件可以是单个 Update 对象、Update 数组，或每行一个 Update 的 JSONL。
+未指定 --url / --secret 时从 config.yml 的 bot.webhook 读取。
+"""
+import argparse
+import json
+import sys
+
+import httpx
+import yaml
+
+
+def load_updates(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    try:
+        data = json.loads(text)
+        return data if isinstance(data, list) else [data]
+    except json.JSONDecodeError:
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='向本地 Webhook 发送录制的 Telegram Update')
+    parser.add_argument('files', nargs='+', help='Update 的 JSON / JSONL 文件')
+    parser.add_argument('--url', help='Webhook 地址，默认 http://127.0.0.1:<port>/<url_path>')
+    parser.add_argument('--secret', help='X-Telegram-Bot-Api-Secret-Token 请求头')
+    parser.add_argument('--config', default='config.yml', help='配置文件路径')
+    args = parser.parse_args()
+
+    webhook = {}
+    if args.url is None or args.secret is None:
+        try:
+            with open(args.config, 'r') as f:
+                webhook = (yaml.safe_load(f).get('bot') or {}).get('webhook') or {}
+        except FileNotFoundError:
+            pass
+
+    url = args.url or f"http://127.0.0.1:{webhook.get('port', 8443)}/{webhook.get('url_path', 'telegram')}"
+    secret = args.secret if args.secret is not None else webhook.get('secret_token')
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else {}
+
+    failed = 0
+    with httpx.Client(timeout=10) as client:
+        for path in args.files:
+            for update in load_updates(path):
+                response = client.post(url, json=update, headers=headers)
+                print(f"update_id={update.get('update_id')} -> {response.status_code}")
+                if response.status_code != 200:
+                    failed += 1
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
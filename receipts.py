@@ -0,0 +1,69 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List
+
+
+class ReadReceiptBatcher:
+    """批量发送已读回执
+
+    收到的消息指纹按会话暂存，在 delay 秒后用一次请求全部标记为已读，
+    客服回复前也会立即发送，消息处理不再等待已读请求完成。
+    """
+
+    def __init__(self, send: Callable[[str, List[str]], Awaitable[Any]], delay: float = 2):
+        self.send = send
+        self.delay = delay
+        self._pending: Dict[str, List[str]] = {}
+        self._timers: Dict[str, asyncio.Task] = {}
+
+        # 统计信息
+        self.received = 0
+        self.requests = 0
+        self.failed = 0
+
+    def add(self, session_id: str, fingerprint: str):
+        """登记一条需要标记为已读的消息"""
+        self.received += 1
+        self._pending.setdefault(session_id, []).append(fingerprint)
+        if session_id not in self._timers:
+            self._timers[session_id] = asyncio.create_task(self._flush_later(session_id))
+
+    async def _flush_later(self, session_id: str):
+        await asyncio.sleep(self.delay)
+        # 计时结束，之后的 flush 不能再取消当前任务
+        self._timers.pop(session_id, None)
+        await self._send(session_id)
+
+    async def flush(self, session_id: str):
+        """立即发送该会话暂存的已读回执"""
+        timer = self._timers.pop(session_id, None)
+        if timer is not None:
+            timer.cancel()
+        await self._send(session_id)
+
+    async def _send(self, session_id: str):
+        fingerprints = self._pending.pop(session_id, None)
+        if not fingerprints:
+            return
+        self.requests += 1
+        try:
+            await self.send(session_id, fingerprints)
+        except Exception as e:
+            self.failed += 1
+            logging.error(f"标记会话 {session_id} 的消息为已读失败: {e}")
+
+    async def close(self):
+        """发送全部暂存的已读回执"""
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        await asyncio.gather(*(self._send(session_id) for session_id in list(self._pending)))
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取已读回执统计信息"""
+        return {
+            'pending_sessions': len(self._pending),
+            'received': self.received,
+            'requests': self.requests,
+            'failed': self.failed
+        }
@@ -0,0 +1,135 @@
+import logging
+from collections import OrderedDict, UserDict
+from typing import Any, Callable, Dict, Optional
+
+
+class SessionMap(UserDict):
+    """会话数据映射，同时维护 sessionId <-> topicId 双向索引
+
+    作为 Application 的 bot_data 使用，所有写入（新建会话、持久化加载、
+    过期清理）都会经过 __setitem__/__delitem__，索引因此始终与数据保持一致，
+    按话题查找会话只需一次字典查询。
+
+    绑定持久化存储后（见 attach），映射只在内存中保留最近使用的 max_size 个会话，
+    未命中时按需从存储中读取单个会话。注意 ``in`` 和迭代只反映内存中的会话。
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._topic_to_session: Dict[int, str] = {}
+        self._loader = None
+        self._in_use: Optional[Callable[[str], bool]] = None
+        self.max_size = 0
+        self.hits = 0
+        self.misses = 0
+        self.data = OrderedDict()
+        self.update(*args, **kwargs)
+
+    def attach(self, loader, max_size: int = 0, in_use: Optional[Callable[[str], bool]] = None):
+        """绑定持久化存储，max_size 为 0 时不限制内存中的会话数
+
+        in_use 返回 True 的会话（仍有进行中的任务持有会话数据）不会被淘汰，
+        否则下一条消息会读出第二份会话数据，两份数据保存时互相覆盖。
+        """
+        self._loader = loader
+        self.max_size = max_size
+        self._in_use = in_use
+        self._evict()
+
+    def __getitem__(self, session_id: str) -> Dict[str, Any]:
+        if session_id in self.data:
+            self.hits += 1
+            self.data.move_to_end(session_id)
+            return self.data[session_id]
+
+        self.misses += 1
+        session_data = self._loader.get_session(session_id) if self._loader else None
+        if session_data is None:
+            raise KeyError(session_id)
+        self[session_id] = session_data
+        logging.debug(f"从持久化存储恢复会话: {session_id}")
+        return session_data
+
+    def get(self, session_id: str, default=None):
+        try:
+            return self[session_id]
+        except KeyError:
+            return default
+
+    def __setitem__(self, session_id: str, session_data: Dict[str, Any]):
+        old = self.data.get(session_id)
+        if old is not None:
+            self._unbind(session_id, old.get('topicId'))
+        self.data[session_id] = session_data
+        self.data.move_to_end(session_id)
+        topic_id = session_data.get('topicId') if session_data else None
+        if topic_id is not None:
+            self._topic_to_session[topic_id] = session_id
+        self._evict()
+
+    def __delitem__(self, session_id: str):
+        session_data = self.data.pop(session_id)
+        self._unbind(session_id, session_data.get('topicId'))
+
+    def pop(self, session_id: str, default=None):
+        """只从内存中移除会话，不会从持久化存储读取"""
+        session_data = self.data.pop(session_id, None)
+        if session_data is None:
+            return default
+        self._unbind(session_id, session_data.get('topicId'))
+        return session_data
+
+    def _unbind(self, session_id: str, topic_id: Optional[int]):
+        if topic_id is not None and self._topic_to_session.get(topic_id) == session_id:
+            del self._topic_to_session[topic_id]
+
+    def _evict(self):
+        # 会话的修改在发生时已经写入持久化存储，淘汰时直接丢弃即可；
+        # 仍在使用的会话跳过，暂时超出 max_size
+        excess = len(self.data) - self.max_size if self.max_size else 0
+        if excess <= 0:
+            return
+        victims = []
+        for session_id in self.data:
+            if len(victims) >= excess:
+                break
+            if self._in_use is None or not self._in_use(session_id):
+                victims.append(session_id)
+        for session_id in victims:
+            session_data = self.data.pop(session_id)
+            self._unbind(session_id, session_data.get('topicId'))
+
+    def clear(self):
+        self.data.clear()
+        self._topic_to_session.clear()
+
+    def get_session_id(self, topic_id: Optional[int]) -> Optional[str]:
+        """根据 Telegram 话题 ID 查找对应的 Crisp 会话 ID"""
+        if topic_id is None:
+            return None
+        session_id = self._topic_to_session.get(topic_id)
+        if session_id is not None:
+            self.hits += 1
+            self.data.move_to_end(session_id)
+            return session_id
+
+        self.misses += 1
+        if self._loader is None:
+            return None
+        session_id, session_data = self._loader.get_session_by_topic(topic_id)
+        if session_id is not None:
+            self[session_id] = session_data
+        return session_id
+
+    def get_topic_id(self, session_id: str) -> Optional[int]:
+        """根据 Crisp 会话 ID 查找对应的 Telegram 话题 ID"""
+        session_data = self.get(session_id)
+        return session_data.get('topicId') if session_data else None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取内存缓存统计信息"""
+        return {
+            'cached_sessions': len(self.data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses
+        }
@@ -0,0 +1,231 @@
+import asyncio
+import bisect
+import itertools
+import logging
+import time
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+# 优先级通道，数值越小越先发送；不在表中的接口（如 getFile）不做限流
+PRIORITY_TOPIC = 0
+PRIORITY_MESSAGE = 1
+PRIORITY_EDIT = 2
+
+ENDPOINT_PRIORITIES = {
+    'createForumTopic': PRIORITY_TOPIC,
+    'sendMessage': PRIORITY_MESSAGE,
+    'sendPhoto': PRIORITY_MESSAGE,
+    'sendDocument': PRIORITY_MESSAGE,
+    'sendMediaGroup': PRIORITY_MESSAGE,
+    'copyMessage': PRIORITY_MESSAGE,
+    'forwardMessage': PRIORITY_MESSAGE,
+    'editMessageText': PRIORITY_EDIT,
+    'editMessageReplyMarkup': PRIORITY_EDIT,
+    'editMessageCaption': PRIORITY_EDIT,
+}
+
+LANE_NAMES = {PRIORITY_TOPIC: 'topic', PRIORITY_MESSAGE: 'message', PRIORITY_EDIT: 'edit'}
+
+
+class TokenBucket:
+    """令牌桶：每秒补充 rate 个令牌，最多积累 capacity 个"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        # 收到 RetryAfter 后暂停到该时间点
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """距离可以取出一个令牌还需等待的秒数"""
+        self._refill(now)
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class TelegramScheduler(BaseRateLimiter[Dict[str, Any]]):
+    """Telegram 发送调度器
+
+    作为 Application 的 rate_limiter 使用，所有经过 Bot 的请求都会先进入这里：
+
+    - 全局令牌桶限制每秒发送的消息总数，每个聊天另有一个令牌桶限制单个群组的发送频率
+    - 等待中的请求按优先级通道排队：创建话题最先，其次是客户消息和回复，信息卡片的
+      编辑最后，同一通道内按到达顺序发送
+    - 收到 RetryAfter 时暂停对应聊天（没有聊天 ID 时暂停全局）并在等待后重试
+
+    可以通过 ``rate_limit_args={'priority': n}`` 为单次调用指定优先级。
+    """
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        config = config or {}
+        self.global_rate = config.get('global_rate', 30)
+        self.global_burst = config.get('global_burst', self.global_rate)
+        # Telegram 对群组的限制约为每分钟 20 条消息
+        self.chat_rate = config.get('chat_rate', 20) / config.get('chat_period', 60)
+        self.chat_burst = config.get('chat_burst', 3)
+        self.max_retries = config.get('max_retries', 3)
+        # 编辑通道的请求最长排队时间（秒），超时后放弃，避免过时的编辑无限积压，0 为不限制
+        self.edit_max_wait = config.get('edit_max_wait', 60)
+
+        self._global = TokenBucket(self.global_rate, self.global_burst)
+        self._chats: Dict[Any, TokenBucket] = {}
+        self._waiters: List[tuple] = []
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._pump: Optional[asyncio.Task] = None
+
+        # 统计信息
+        self._sent: Dict[int, int] = {lane: 0 for lane in LANE_NAMES}
+        self._retried = 0
+        self._failed = 0
+        self._expired = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    async def initialize(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._pump = asyncio.create_task(self._run())
+
+    async def shutdown(self) -> None:
+        if self._pump is not None:
+            self._pump.cancel()
+            await asyncio.gather(self._pump, return_exceptions=True)
+            self._pump = None
+        for *_, future in self._waiters:
+            if not future.done():
+                future.cancel()
+        self._waiters = []
+
+    def _chat_bucket(self, chat_id: Any) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _acquire(self, priority: int, seq: int, chat_id: Any):
+        """排队等待发送许可"""
+        future = asyncio.get_running_loop().create_future()
+        bisect.insort(self._waiters, (priority, seq, chat_id, future))
+        self._wakeup.set()
+        if priority == PRIORITY_EDIT and self.edit_max_wait:
+            try:
+                # 超时后 future 被取消，发送循环会跳过它
+                await asyncio.wait_for(future, self.edit_max_wait)
+            except asyncio.TimeoutError:
+                self._expired += 1
+                raise
+        else:
+            await future
+
+    async def _run(self):
+        """按优先级依次发放令牌"""
+        while True:
+            if not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            wait = self._global.delay(now)
+            if wait == 0:
+                # 选出第一个所在聊天有令牌的请求，被限流的聊天不会阻塞其他聊天
+                wait = None
+                for index, (priority, _, chat_id, future) in enumerate(self._waiters):
+                    if future.done():
+                        del self._waiters[index]
+                        break
+                    chat_wait = self._chat_bucket(chat_id).delay(now) if chat_id is not None else 0.0
+                    if chat_wait == 0:
+                        del self._waiters[index]
+                        self._global.take()
+                        if chat_id is not None:
+                            self._chats[chat_id].take()
+                        future.set_result(None)
+                        break
+                    wait = chat_wait if wait is None else min(wait, chat_wait)
+                if wait is None:
+                    continue
+
+            # 没有可发送的请求，等到最早的令牌补充或者有新请求到达
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict[str, Any], List[Dict[str, Any]]]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Dict[str, Any]],
+    ) -> Union[bool, Dict[str, Any], List[Dict[str, Any]]]:
+        priority = (rate_limit_args or {}).get('priority', ENDPOINT_PRIORITIES.get(endpoint))
+        chat_id = data.get('chat_id')
+        # 重试时沿用原来的序号，保持同一通道内的发送顺序
+        seq = next(self._seq)
+
+        for attempt in range(self.max_retries + 1):
+            if priority is not None:
+                enqueued_at = time.monotonic()
+                await self._acquire(priority, seq, chat_id)
+                wait_time = time.monotonic() - enqueued_at
+                self._total_wait += wait_time
+                self._max_wait = max(self._max_wait, wait_time)
+
+            try:
+                result = await callback(*args, **kwargs)
+                if priority is not None:
+                    self._sent[priority] = self._sent.get(priority, 0) + 1
+                return result
+            except RetryAfter as error:
+                retry_after = error.retry_after
+                if hasattr(retry_after, 'total_seconds'):
+                    retry_after = retry_after.total_seconds()
+                if attempt >= self.max_retries:
+                    self._failed += 1
+                    raise
+                self._retried += 1
+                logging.warning(f"Telegram 限流 {endpoint} (chat {chat_id})，{retry_after} 秒后重试")
+                # 暂停对应的令牌桶，其他请求也会一起等待
+                (self._chat_bucket(chat_id) if chat_id is not None else self._global).pause(retry_after)
+                if priority is None:
+                    await asyncio.sleep(retry_after)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取发送队列统计信息"""
+        queued = {name: 0 for name in LANE_NAMES.values()}
+        for priority, *_ in self._waiters:
+            name = LANE_NAMES.get(priority, str(priority))
+            queued[name] = queued.get(name, 0) + 1
+        sent = sum(self._sent.values())
+        return {
+            'queued': queued,
+            'queue_depth': len(self._waiters),
+            'sent': {LANE_NAMES.get(lane, str(lane)): count for lane, count in self._sent.items()},
+            'retried': self._retried,
+            'failed': self._failed,
+            'expired': self._expired,
+            'avg_wait': self._total_wait / (sent + self._retried) if sent + self._retried else 0.0,
+            'max_wait': self._max_wait
+        }
@@ -0,0 +1,99 @@
+import hashlib
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from cache import TTLCache
+
+# 各模型的上下文窗口大小，按前缀匹配，越具体的前缀越靠前
+MODEL_CONTEXT_SIZES = (
+    ('gpt-4o', 128000),
+    ('gpt-4.1', 1047576),
+    ('gpt-4-turbo', 128000),
+    ('gpt-4-1106', 128000),
+    ('gpt-4-0125', 128000),
+    ('gpt-4-32k', 32768),
+    ('gpt-4', 8192),
+    ('gpt-3.5-turbo-instruct', 4096),
+    ('gpt-3.5-turbo-16k', 16385),
+    ('gpt-3.5-turbo-0613', 4096),
+    ('gpt-3.5-turbo-0301', 4096),
+    ('gpt-3.5-turbo', 16385),
+    ('o1', 200000),
+    ('o3', 200000),
+    ('o4', 200000),
+)
+DEFAULT_CONTEXT_SIZE = 8192
+
+# 每条消息的格式开销
+MESSAGE_OVERHEAD = 4
+
+
+class TokenCounter:
+    """带缓存的 token 计数器
+
+    编码器只加载一次，每段文本的 token 数按内容哈希缓存，构建上下文时
+    历史消息和固定的系统提示词都不需要重复编码。
+    """
+
+    def __init__(self, model: str, context_size: Optional[int] = None, cache_size: int = 50000):
+        self.model = model
+        self.context_size = context_size or get_context_size(model)
+        self._encoding = None
+        self._cache = TTLCache(ttl=0, max_size=cache_size)
+
+    @property
+    def encoding(self):
+        # 首次使用时才导入 tiktoken 并加载编码器；未安装时抛出 ImportError
+        if self._encoding is None:
+            import tiktoken
+            try:
+                self._encoding = tiktoken.encoding_for_model(self.model)
+            except KeyError:
+                self._encoding = tiktoken.get_encoding("cl100k_base")  # 默认编码器
+            logging.info(f"已加载 {self.model} 的 tiktoken 编码器: {self._encoding.name}")
+        return self._encoding
+
+    def count(self, text: str) -> int:
+        """返回一条消息的 token 数（含消息格式开销）"""
+        key = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+        tokens = self._cache.get(key)
+        if tokens is None:
+            tokens = len(self.encoding.encode(text)) + MESSAGE_OVERHEAD
+            self._cache.set(key, tokens)
+        return tokens
+
+    def build_messages(self, system: str, history: List[Dict[str, str]], current: str,
+                       reserve: int = 1000) -> Tuple[List[Dict[str, str]], int]:
+        """在上下文窗口内组装消息列表
+
+        保留系统消息和当前消息，从最新的历史消息开始向前添加，直到达到
+        context_size - reserve 的限制。返回 (消息列表, 预估 token 数)。
+        """
+        budget = self.context_size - reserve
+        used = self.count(system) + self.count(current)
+
+        kept = []
+        for msg in reversed(history):
+            tokens = self.count(msg["content"])
+            if used + tokens > budget:
+                break
+            kept.append({"role": msg["role"], "content": msg["content"]})
+            used += tokens
+        kept.reverse()
+
+        messages = [{"role": "system", "content": system}]
+        messages.extend(kept)
+        messages.append({"role": "user", "content": current})
+        return messages, used
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取缓存统计信息"""
+        return self._cache.get_stats()
+
+
+def get_context_size(model: str) -> int:
+    """根据模型名称查找上下文窗口大小"""
+    for prefix, size in MODEL_CONTEXT_SIZES:
+        if model.startswith(prefix):
+            return size
+    return DEFAULT_CONTEXT_SIZE